@@ -0,0 +1,64 @@
+"""Archiving completed queue items from qitem to qitemarchive for project Coupon"""
+import logging
+import threading
+import time
+
+from sqlalchemy import delete, insert
+from sqlmodel import Session, select
+
+import db
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+COMPLETED = db.Qitem.completed_at.is_not(None)  # pylint: disable=no-member
+
+
+def archive(batch_size: int | None = None) -> int:
+    """
+    Implement POST /queue/archive: move completed queue items to qitemarchive, in batches of batch_size,
+    each batch by INSERT ... SELECT and DELETE in a transaction of its own. Return the number of items moved.
+    So qitem keeps the waiting items mostly, queue reads and writes don't wade through order history.
+    """
+    batch_size = batch_size or settings.archive_batch_size
+    columns = list(db.Qitem.__table__.columns.keys())
+    moved = 0
+    while True:
+        with Session(db.engine) as session:
+            batch = (
+                select(db.Qitem.id)
+                .where(COMPLETED)
+                .order_by(db.Qitem.id)
+                .limit(batch_size)
+            )
+            if session.get_bind().dialect.name == "postgresql":
+                batch = batch.with_for_update(skip_locked=True)  # another archiver's
+            qitem_ids = session.exec(batch).all()
+            if not qitem_ids:
+                return moved
+            session.execute(
+                insert(db.QitemArchive).from_select(
+                    columns,
+                    select(*[db.Qitem.__table__.c[column] for column in columns]).where(
+                        db.Qitem.id.in_(qitem_ids)
+                    ),
+                )
+            )
+            session.execute(delete(db.Qitem).where(db.Qitem.id.in_(qitem_ids)))
+            session.commit()
+        moved += len(qitem_ids)
+
+
+def start() -> None:
+    """Archive every settings.archive_interval secs in a daemon thread, if set"""
+    if settings.archive_interval > 0:
+        threading.Thread(target=_archive_forever, daemon=True).start()
+
+
+def _archive_forever() -> None:
+    while True:
+        time.sleep(settings.archive_interval)
+        try:
+            archive()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Could not archive queue items")
@@ -13,6 +13,12 @@ class CreateCoupon(BaseModel):
     user_name: str | None = None  # None means for everyone
 
 
+class CreateCouponBatch(CreateCoupon):
+    """Record Structure for Create Coupons in bulk, all alike but with generated coupon_name"""
+
+    count: int  # number of coupons to generate
+
+
 class CreateQitem(BaseModel):
     """Record Structure for Create Queue Item (place order)"""
 
@@ -20,3 +26,15 @@ class CreateQitem(BaseModel):
     coupon_name: str | None = None
     list_price: int
     order_id: str  # API client's own reference. Note it's str, not int
+
+
+class Lease(BaseModel):
+    """Record Structure for a worker's lease on queue items"""
+
+    worker: str  # worker's own unique name
+
+
+class ClaimQitems(Lease):
+    """Record Structure for Claim Queue Items"""
+
+    count: int = 1
@@ -0,0 +1,275 @@
+"""
+Microbenchmarks of the service layer hot paths of project Coupon
+
+Seeds the tables at each size, times service functions and endpoints (through TestClient),
+writes results as JSON, optionally compares them to a baseline written earlier.
+It empties tables coupon, qitem and the counters, so give it a database of its own:
+
+    python benchmarks/bench_service.py --db-url sqlite:///bench.db --sizes 1000 100000 --output baseline.json
+    python benchmarks/bench_service.py --db-url sqlite:///bench.db --sizes 1000 100000 --compare baseline.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable
+
+bench_dir = os.path.join(os.path.dirname(__file__))
+sys.path.append(os.path.join(bench_dir, ".."))
+
+SEED_CHUNK_ROWS = 5000  # rows per multi-row INSERT when seeding
+USERS = ["john_smith", "maria_de_silva"]  # see settings.init_db_records
+
+
+def parse_args() -> argparse.Namespace:
+    """Command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--db-url", required=True, help="database to empty and seed")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument(
+        "--repeat", type=int, default=50, help="timed calls per benchmark"
+    )
+    parser.add_argument(
+        "--waiting-ratio", type=float, default=0.1, help="queue items not completed yet"
+    )
+    parser.add_argument(
+        "--max-full-listing", type=int, default=100000, help="skip whole listings above"
+    )
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="baseline JSON written by --output earlier")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="median ratio counted as regression",
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    """Run benchmarks, return exit code: 1 if there is a regression against baseline"""
+    args = parse_args()
+    os.environ["DB_URL"] = args.db_url  # before settings are read
+
+    # pylint: disable=import-outside-toplevel  # settings need DB_URL first
+    import db
+    from config import settings
+
+    settings.max_queue_len = (
+        sys.maxsize
+    )  # seeded queues are longer than the waiting room
+    db.init()
+    results = {}
+    for size in args.sizes:
+        seed(db, size, args.waiting_ratio)
+        results[str(size)] = run(size, args)
+        for name, timing in results[str(size)].items():
+            print(
+                f"{size:>9} {name:<40} median {timing['median_ms']:9.3f} ms  min {timing['min_ms']:9.3f} ms"
+            )
+    report = {
+        "meta": {
+            "dialect": db.engine.dialect.name,
+            "python": platform.python_version(),
+            "date": datetime.datetime.utcnow().isoformat(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            return compare(json.load(baseline)["results"], results, args.threshold)
+    return 0
+
+
+def seed(db, size: int, waiting_ratio: float) -> None:
+    """Empty variable tables, then insert size coupons and size queue items by multi-row INSERTs"""
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import delete, insert
+    from sqlmodel import Session
+    import cache
+
+    cache.clear_all()
+    now = datetime.datetime.utcnow()
+    n_waiting = int(size * waiting_ratio)
+    with Session(db.engine) as session:
+        for cls in [
+            db.Qitem,
+            db.QitemArchive,
+            db.UserStat,
+            db.CouponUserUse,
+            db.CouponUse,
+            db.Coupon,
+        ]:
+            session.execute(delete(cls))
+        for start in range(0, size, SEED_CHUNK_ROWS):
+            rows = range(start, min(start + SEED_CHUNK_ROWS, size))
+            session.execute(
+                insert(db.Coupon).values(
+                    [
+                        {
+                            "coupon_name": f"BENCH{i:07d}",
+                            "params": {
+                                "pricing": {"percent": -10},
+                                "queuing": {"vip": 1},
+                            },
+                            "max_use_count_per_user": None,
+                            "max_use_count_global": size,
+                            "user_name": None,
+                        }
+                        for i in rows
+                    ]
+                )
+            )
+            session.execute(
+                insert(db.Qitem).values(
+                    [
+                        {
+                            "created_at": now,
+                            "vip": int(i % 10 == 0),
+                            "user_name": USERS[i % len(USERS)],
+                            "order_id": f"BENCH{i}",
+                            "coupon_name": f"BENCH{i:07d}",
+                            "final_price": 18000,
+                            # the latest ones are waiting
+                            "completed_at": None if i >= size - n_waiting else now,
+                        }
+                        for i in rows
+                    ]
+                )
+            )
+        session.commit()
+
+
+def run(size: int, args: argparse.Namespace) -> dict:
+    """Time service functions and endpoints on the seeded tables"""
+    # pylint: disable=import-outside-toplevel
+    from fastapi.testclient import TestClient
+    from sqlmodel import Session, select
+
+    import base_model as bm
+    import coupon
+    import db
+    import queue_item
+    from coupon_params import pricing, queuing
+    from main import app
+
+    client = TestClient(app)
+    coupon_name = f"BENCH{size // 2:07d}"
+    with Session(db.engine) as session:
+        waiting_id = session.exec(
+            select(db.Qitem.id).where(queue_item.WAITING).order_by(db.Qitem.id)
+        ).first()
+    qitem = bm.CreateQitem(
+        user_name=USERS[0], coupon_name=coupon_name, list_price=20000, order_id="B"
+    )
+    order = qitem.dict()
+    new_record = queue_item._new_record  # pylint: disable=protected-access
+    with Session(db.engine) as session:
+        # a redemption before, so apply times the keyed counter UPDATE, not the backfill of a new counter
+        coupon.apply(qitem, new_record(qitem), session)
+        session.commit()
+
+    def apply():
+        with Session(db.engine) as session:  # rolled back at close
+            coupon.apply(qitem, new_record(qitem), session)
+
+    def uncached(function: Callable):
+        def call():
+            coupon.cached_coupons.invalidate(coupon_name)
+            return function()
+
+        return call
+
+    def params(function: Callable, value):
+        def call():
+            with Session(db.engine) as session:
+                function(
+                    {"user_name": USERS[0], "final_price": 20000}, value, {}, session
+                )
+
+        return call
+
+    benchmarks = {
+        "coupon.apply": apply,
+        "coupon.get_by_name": uncached(lambda: coupon.get_by_name(coupon_name)),
+        "coupon.get_by_name (cached)": lambda: coupon.get_by_name(coupon_name),
+        "coupon.get_all(limit=100)": lambda: coupon.get_all(limit=100),
+        "coupon.create (generated name)": lambda: coupon.create(bm.CreateCoupon()),
+        "coupon._generate_name": lambda: coupon._generate_name(  # pylint: disable=protected-access
+            bm.CreateCoupon()
+        ),
+        "pricing.percent": params(pricing.percent, -10),
+        "pricing.amount": params(pricing.amount, -2000),
+        "pricing.frequenter_percent": params(pricing.frequenter_percent, -10),
+        "queuing.vip": params(queuing.vip, 1),
+        "queue_item.create": lambda: queue_item.create(qitem),
+        "queue_item.get_len": queue_item.get_len,
+        "queue_item.get_position": lambda: queue_item.get_position(waiting_id),
+        "queue_item.get_all(limit=100)": lambda: queue_item.get_all(limit=100),
+        "POST /queue": lambda: client.post("/queue", json=order),
+        "GET /coupon/{coupon_name}": uncached(
+            lambda: client.get(f"/coupon/{coupon_name}")
+        ),
+        # fresh: not from the listing cache
+        "GET /queue?limit=100": lambda: client.get(
+            "/queue", params={"limit": 100, "fresh": True}
+        ),
+        "GET /queue?limit=100 (cached)": lambda: client.get(
+            "/queue", params={"limit": 100}
+        ),
+        "GET /queue?limit=100&format=columnar": lambda: client.get(
+            "/queue", params={"limit": 100, "format": "columnar", "fresh": True}
+        ),
+        "GET /queue/len": lambda: client.get("/queue/len"),
+        "GET /queue/{qitem_id}/position": lambda: client.get(
+            f"/queue/{waiting_id}/position"
+        ),
+    }
+    if size <= args.max_full_listing:
+        benchmarks.update(
+            {
+                "queue_item.get_all": queue_item.get_all,
+                "coupon.get_all": coupon.get_all,
+                "GET /queue": lambda: client.get("/queue", params={"fresh": True}),
+                "GET /coupon": lambda: client.get("/coupon", params={"fresh": True}),
+            }
+        )
+    return {name: timed(function, args.repeat) for name, function in benchmarks.items()}
+
+
+def timed(function: Callable, repeat: int) -> dict:
+    """Call function repeat times (after one warm-up call), return timing in msecs"""
+    function()
+    msecs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        msecs.append(1000 * (time.perf_counter() - start))
+    return {"median_ms": statistics.median(msecs), "min_ms": min(msecs), "n": repeat}
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> int:
+    """Print median ratios against baseline, return 1 if any of them is above threshold"""
+    regressions = 0
+    for size, timings in results.items():
+        for name, timing in timings.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            ratio = timing["median_ms"] / max(base["median_ms"], 1e-6)
+            flag = "REGRESSION" if ratio > threshold else ""
+            regressions += bool(flag)
+            print(f"{size:>9} {name:<40} {ratio:6.2f}x baseline {flag}")
+    return int(regressions > 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""In-process read-through cache for reference data (users, coupons) of project Coupon"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+import exception as xc
+from config import settings
+
+caches: dict[str, "Cache"] = {}
+_versions: dict[str, int] = {}  # change version of tables, see bump()
+_versions_lock = threading.Lock()
+
+
+class Cache:
+    """
+    Bounded LRU cache with TTL. Coupon404 raised by the loader is cached too (negative caching),
+    with its own, shorter TTL, so a name created by another worker process shows up soon.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data: OrderedDict[
+            Hashable, tuple[float, Any, xc.Coupon404 | None]
+        ] = OrderedDict()
+        caches[name] = self
+
+    def get(
+        self,
+        key: Hashable,
+        loader: Callable[[], Any],
+        keep: Callable[[Any], bool] | None = None,
+    ) -> Any:
+        """Return cached value of key, or call loader() and cache its result, if keep(result) when given"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                _, value, err = entry
+                if err is not None:
+                    raise type(err)(
+                        *err.args
+                    )  # fresh one, don't grow a shared traceback
+                return value
+            self.misses += 1
+        try:
+            value = loader()
+        except xc.Coupon404 as err:
+            self._put(key, now + self.negative_ttl, None, err)
+            raise
+        if keep is None or keep(value):
+            self._put(key, now + self.ttl, value, None)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value known already"""
+        self._put(key, time.monotonic() + self.ttl, value, None)
+
+    def _put(self, key: Hashable, expires: float, value: Any, err) -> None:
+        with self._lock:
+            self._data[key] = (expires, value, err)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Forget key, e.g. after it's been created"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Forget everything"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Size and hit/miss counters"""
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def new(name: str) -> Cache:
+    """Cache sized by settings"""
+    return Cache(
+        name, settings.cache_maxsize, settings.cache_ttl, settings.cache_negative_ttl
+    )
+
+
+def bump(table_name: str) -> None:
+    """Count a change of table_name by this process, so what's cached by version() is not used any more"""
+    with _versions_lock:
+        _versions[table_name] = _versions.get(table_name, 0) + 1
+
+
+def version(table_name: str) -> int:
+    """Change version of table_name, to be part of cache keys of what is read from it"""
+    return _versions.get(table_name, 0)
+
+
+def clear_all() -> None:
+    """Forget everything in every cache, for test only"""
+    for one_cache in caches.values():
+        one_cache.clear()
+
+
+def stats() -> dict:
+    """Implement GET /cache"""
+    return {name: one_cache.stats() for name, one_cache in caches.items()}
@@ -1,16 +1,22 @@
 """Coupon service layer for project Coupon"""
+import inspect
 import json
 import sys
-import random
+from typing import Any, Callable, Iterator
 
 from sqlmodel import Session, select
-from sqlalchemy import func
+from sqlalchemy import String, cast, func, literal, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.exc import IntegrityError
 
 from config import settings
 import base_model as bm
+import cache
 import db
 import exception as xc
+import name_pool
+import serialize
 import coupon_params.pricing
 import coupon_params.queuing
 
@@ -21,6 +27,22 @@ coupon_params = {
 
 coupon = sys.modules[__name__]  # ~import sql_model (self) as db
 NTRIES_INSERT_RAND = 10
+INSERT_CHUNK_ROWS = (
+    1000  # rows per multi-row INSERT, keeps bind params below SQLite's limit
+)
+cached_coupons = cache.new("coupons")
+USER_LIMIT_MESSAGE = "You cannot use this coupon more"
+GLOBAL_LIMIT_MESSAGE = (
+    "Sorry, the framework for this coupon has been exhausted by customers"
+)
+compiled_coupons = cache.new("compiled_coupons")
+COUPON_KEYS = (  # of GET /coupon
+    "coupon_name",
+    "max_use_count_per_user",
+    "max_use_count_global",
+    "user_name",
+    "params",
+)
 
 
 def create(coupon_item: bm.CreateCoupon) -> dict:
@@ -28,6 +50,7 @@ def create(coupon_item: bm.CreateCoupon) -> dict:
 
     # to make sure user exists in user table
     db.get_one_record("user", "user_name", coupon_item.user_name)
+    pipeline = compile_params(coupon_item.params)  # invalid coupon is not created
 
     if coupon_item.coupon_name is None:
         _generate_name(coupon_item)
@@ -38,6 +61,7 @@ def create(coupon_item: bm.CreateCoupon) -> dict:
             if "already exists" in str(err):
                 raise xc.CouponUserError("coupon_name already in use") from err
             raise xc.CouponUserError(f"{err}") from err
+    compiled_coupons.put(coupon_item.coupon_name, pipeline)
 
     return {"coupon_name": coupon_item.coupon_name}
 
@@ -47,98 +71,430 @@ def create(coupon_item: bm.CreateCoupon) -> dict:
 #     return _coupon_dict(*db.get_one_record("coupon", coupon_name))
 
 
-def get_by_name(coupon_name: str) -> dict:
-    """Implement GET /coupon/{coupon_name}"""
-    with Session(db.engine) as session:
-        statement = select(db.Coupon).where(db.Coupon.coupon_name == coupon_name)
-        first = session.exec(statement).first() or xc.raiser(
-            xc.Coupon404("No such coupon_name")
+def get_by_name(coupon_name: str, session: Session = None) -> dict:
+    """Implement GET /coupon/{coupon_name}
+    Coupons never change once created, so they are cached (limits are counted elsewhere).
+    Without session, from a read replica, but a miss is confirmed on the primary
+    """
+    return cached_coupons.get(
+        coupon_name,
+        lambda: _coupon_dict(
+            db.get_one_record("coupon", "coupon_name", coupon_name, session=session)
+        ),
+    )
+
+
+def get_all(
+    after: str | None = None,
+    limit: int | None = None,
+    param: str | None = None,
+    value: str | None = None,
+    fresh: bool = False,
+    columnar: bool = False,
+) -> dict:
+    """
+    Implement GET /coupon, a page of limit coupons after coupon_name after if limit is given,
+    only coupons having param (e.g. queuing.vip) if given, having it with JSON value (e.g. 1) if given too.
+    Coupons as dicts, or as one list per key if columnar.
+    From a read replica, unless fresh, see db.read_engines()
+    """
+    rows = list(_stream_rows(_statement(after, limit, param, value), fresh))
+    coupons = (
+        serialize.columns(COUPON_KEYS, rows)
+        if columnar
+        else [dict(zip(COUPON_KEYS, row)) for row in rows]
+    )
+    if limit is None:
+        return {"coupons": coupons}
+    next_after = rows[-1][0] if len(rows) == limit else None  # coupon_name
+    return {"coupons": coupons, "next": next_after}
+
+
+def stream_all(
+    after: str | None = None,
+    limit: int | None = None,
+    param: str | None = None,
+    value: str | None = None,
+    fresh: bool = False,
+) -> Iterator[dict]:
+    """Implement GET /coupon?format=ndjson, in coupon_name order, from a server side cursor"""
+    rows = _stream_rows(_statement(after, limit, param, value), fresh)
+    return (dict(zip(COUPON_KEYS, row)) for row in rows)
+
+
+def _statement(
+    after: str | None, limit: int | None, param: str | None, value: str | None
+):
+    """SELECT of COUPON_KEYS columns of listings"""
+    statement = select(*[getattr(db.Coupon, k) for k in COUPON_KEYS]).order_by(
+        db.Coupon.coupon_name
+    )
+    if after is not None:  # keyset pagination
+        statement = statement.where(db.Coupon.coupon_name > after)
+    if param is not None:  # built now, not when streaming has started already
+        statement = statement.where(_param_filter(param, value))
+    elif value is not None:
+        raise xc.CouponUserError("value needs param")
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def _stream_rows(statement, fresh: bool) -> Iterator[tuple]:
+    """Rows of statement, from a server side cursor, no ORM objects"""
+    with Session(db.reader(fresh)) as session:
+        yield from session.execute(
+            statement.execution_options(
+                stream_results=True, yield_per=settings.stream_batch_size
+            )
         )
-    # raise Exception(str(first))
-    return _coupon_dict(first)
 
 
-def get_all() -> dict:
-    """Implement GET /coupon"""
-    with Session(db.engine) as session:
-        results = session.exec(select(db.Coupon))
-        return {"coupons": [_coupon_dict(*record) for record in results]}
+def _param_filter(param: str, value: str | None):
+    """
+    WHERE clause of coupons having param module_name.func_name, with value (JSON) if not None.
+    Postgres: @> and @? on the GIN index of params; SQLite: json_extract().
+    """
+    module_name, _, func_name = param.partition(".")
+    if module_name not in coupon_params or not func_name.isidentifier():
+        raise xc.CouponUserError(f"Invalid param {param}")
+    if value is not None:
+        try:
+            value = json.loads(value)
+        except ValueError as err:
+            raise xc.CouponUserError(f"Invalid JSON value {value}") from err
+        if isinstance(value, (dict, list)):  # params are scalars, see coupon_params
+            raise xc.CouponUserError(f"Must be value a JSON scalar, not {value}")
+    if db.engine.dialect.name == "postgresql":
+        if value is None:
+            # untyped literal, so Postgres takes it as jsonpath
+            return db.Coupon.params.op("@?")(
+                literal(f"$.{module_name}.{func_name}", String)
+            )
+        return db.Coupon.params.op("@>")(cast({module_name: {func_name: value}}, JSONB))
+    extracted = func.json_extract(db.Coupon.params, f"$.{module_name}.{func_name}")
+    if value is None:
+        return extracted.is_not(None)
+    return extracted == value
 
 
 def _coupon_dict(coupon_item: bm.CreateCoupon | db.Coupon) -> dict:
     """Return what is to be stored internally in Py data struct, also returned by API"""
-    return {
-        **{
-            i: getattr(coupon_item, i)
-            for i in (
-                "coupon_name",
-                "max_use_count_per_user",
-                "max_use_count_global",
-                "user_name",
-            )
-        },
-        "params": getattr(
-            coupon_item, "params", json.loads(getattr(coupon_item, "params_json", "{}"))
-        ),
-    }
+    return {k: getattr(coupon_item, k) for k in COUPON_KEYS}
 
 
-def apply(qitem: bm.CreateQitem, record: dict) -> None:  # modify in-place
-    """Apply coupon params on queue item record before adding to queue"""
+def apply(
+    qitem: bm.CreateQitem, record: dict, session: Session
+) -> None:  # modify in-place
+    """Apply coupon params on queue item record before adding to queue
+    Everything runs in session, i.e. in the same transaction as the queue insert:
+    redemption counters are row locked by their conditional UPDATE until commit
+    """
     if qitem.coupon_name is None:
         return  # no coupon to apply
 
-    coupon_dict = coupon.get_by_name(qitem.coupon_name)
+    coupon_dict = coupon.get_by_name(qitem.coupon_name, session)
+    _check_user(coupon_dict, qitem)
+
+    _count_use(
+        session,
+        db.CouponUserUse,
+        coupon_dict["max_use_count_per_user"],
+        USER_LIMIT_MESSAGE,
+        coupon_name=qitem.coupon_name,
+        user_name=qitem.user_name,
+    )
+    _count_use(
+        session,
+        db.CouponUse,
+        coupon_dict["max_use_count_global"],
+        GLOBAL_LIMIT_MESSAGE,
+        coupon_name=qitem.coupon_name,
+    )
+
+    run_params(coupon_dict, record, session)
+
+
+def _check_user(coupon_dict: dict, qitem: bm.CreateQitem) -> None:
+    """Raise if the coupon is reserved for another user"""
     cuser = coupon_dict["user_name"]
     if cuser is not None and cuser != qitem.user_name:
         raise xc.CouponUserError("This coupon is reserved for another user")
 
-    if maxc := coupon_dict["max_use_count_per_user"] is not None:
-        with Session(db.engine) as session:
-            used_count = session.exec(
-                select([func.count(db.Qitem.id)])
-                .where(db.Qitem.coupon_name == qitem.coupon_name)
-                .where(db.Qitem.user_name == qitem.user_name)
-            ).one()
-        if used_count >= maxc:
-            raise xc.CouponUserError("You cannot use this coupon more")
-    maxc = coupon_dict["max_use_count_global"]
-    if maxc is not None:
-        with Session(db.engine) as session:
-            statement = select(db.Qitem.id).where(
-                db.Qitem.coupon_name == qitem.coupon_name
-            )
-            used_count = len(list(session.exec(statement)))
-        if used_count >= maxc:
-            raise xc.CouponUserError(
-                "Sorry, the framework for this coupon has been exhausted by customers"
-            )
 
+def run_params(coupon_dict: dict, record: dict, session: Session) -> None:
+    """Modify record in-place according to each coupon param, by the compiled pipeline"""
     params = coupon_dict["params"]
-    ret = []
+    pipeline = compiled_coupons.get(
+        coupon_dict["coupon_name"], lambda: compile_params(params)
+    )
+    for function, arg in pipeline:
+        function(record, arg, params, session)
+
+
+def apply_batch(
+    qitems: list[bm.CreateQitem], records: list[dict], session: Session
+) -> tuple[list[dict | None], list[Exception | None]]:
+    """
+    Like apply() for many queue items at once, without redemption limits (see BatchUses).
+    Return coupon dicts and errors, both by item.
+    """
+    coupon_dicts, errors = [], []
+    for qitem, record in zip(qitems, records):
+        try:
+            coupon_dict = None
+            if qitem.coupon_name is not None:
+                coupon_dict = coupon.get_by_name(qitem.coupon_name, session)
+                _check_user(coupon_dict, qitem)
+                run_params(coupon_dict, record, session)
+            coupon_dicts.append(coupon_dict)
+            errors.append(None)
+        except xc.CouponUserError as err:
+            coupon_dicts.append(None)
+            errors.append(err)
+    return coupon_dicts, errors
+
+
+class BatchUses:
+    """
+    Redemption counters needed by a batch of queue items, read and row locked by one SELECT per counter
+    table (after the write lock on SQLite, see db.lock_queue), checked and incremented in memory,
+    written when session is flushed.
+    """
+
+    def __init__(self, session: Session, pairs: list[tuple[dict, str]]):
+        """pairs: (coupon dict, user_name) of each queue item using a coupon"""
+        self.session = session
+        self.counters = {}
+        if pairs and session.get_bind().dialect.name != "postgresql":
+            # SQLite: FOR UPDATE locks nothing, so its write lock before reading
+            db.lock_queue(session)
+        for cls, limit, key_columns in [
+            (db.CouponUserUse, "max_use_count_per_user", ("coupon_name", "user_name")),
+            (db.CouponUse, "max_use_count_global", ("coupon_name",)),
+        ]:
+            keys = {
+                self._key(cls, coupon_dict, user_name)
+                for coupon_dict, user_name in pairs
+                if coupon_dict[limit] is not None
+            }
+            if keys:
+                self._load(cls, key_columns, keys)
+
+    @staticmethod
+    def _key(counter_cls: type, coupon_dict: dict, user_name: str) -> tuple:
+        if counter_cls is db.CouponUse:
+            return (counter_cls, coupon_dict["coupon_name"])
+        return (counter_cls, coupon_dict["coupon_name"], user_name)
+
+    @staticmethod
+    def _where(key_columns: list, keys: set):
+        """WHERE clause of rows of keys: (coupon_name, user_name) IN (...) pairs, not a cross product"""
+        if len(key_columns) == 1:
+            return key_columns[0].in_({key[1] for key in keys})
+        return tuple_(*key_columns).in_([key[1:] for key in keys])
+
+    def _load(self, cls: type, key_columns: tuple, keys: set) -> None:
+        """Lock and read existing counters, backfill missing ones from queue items, archived ones too"""
+        self._select(cls, key_columns, keys)
+        missing = keys - self.counters.keys()
+        if not missing:
+            return
+        history = db.qitem_history(*key_columns)
+        columns = [history.c[column] for column in key_columns]
+        used_counts = {
+            (cls, *row[:-1]): row[-1]
+            for row in self.session.exec(
+                select(*columns, func.count())
+                .where(self._where(columns, missing))
+                .group_by(*columns)
+            )
+        }
+        # a concurrent batch or redemption might insert some of them meanwhile, then those are kept
+        db.insert_ignore(
+            self.session,
+            cls,
+            [
+                {
+                    **dict(zip(key_columns, key[1:])),
+                    "use_count": used_counts.get(key, 0),
+                }
+                for key in missing
+            ],
+        )
+        self._select(cls, key_columns, missing)
+
+    def _select(self, cls: type, key_columns: tuple, keys: set) -> None:
+        """Lock and read counters of keys existing"""
+        where = self._where([getattr(cls, column) for column in key_columns], keys)
+        for counter in self.session.exec(select(cls).where(where).with_for_update()):
+            self.counters[(cls, *(getattr(counter, c) for c in key_columns))] = counter
+
+    def check(self, coupon_dict: dict | None, user_name: str) -> list:
+        """Raise if a limit is reached, else return counters to increment on use"""
+        if coupon_dict is None:
+            return []
+        counters = []
+        for cls, limit, message in [
+            (db.CouponUserUse, "max_use_count_per_user", USER_LIMIT_MESSAGE),
+            (db.CouponUse, "max_use_count_global", GLOBAL_LIMIT_MESSAGE),
+        ]:
+            if coupon_dict[limit] is None:
+                continue
+            counter = self.counters[self._key(cls, coupon_dict, user_name)]
+            if counter.use_count >= coupon_dict[limit]:
+                raise xc.CouponUserError(message)
+            counters.append(counter)
+        return counters
+
+    @staticmethod
+    def use(counters: list) -> None:
+        """Count a redemption checked by check()"""
+        for counter in counters:
+            counter.use_count += 1
+
+
+def compile_params(params: dict) -> list[tuple[Callable, Any]]:
+    """
+    Validate coupon params and resolve them into a pipeline of (function, arg) steps, to be run in order.
+    Runs once per coupon: at create, then cached for apply.
+    """
+    pipeline = []
     for module_name, func_dict in params.items():
+        module = coupon_params.get(module_name)
+        if module is None or not isinstance(func_dict, dict):
+            raise xc.CouponUserError(f"Invalid param {module_name} in {params}")
         for func_name, arg in func_dict.items():
-            ret.append([func_name, arg])
-            try:
-                module = coupon_params[module_name]
-                function = getattr(module, func_name)
-            except (AttributeError, KeyError) as err:  # paranoia
-                raise xc.CouponSystemError(
-                    f"Invalid param {module_name}.{func_name} in {coupon_dict}: {params} {err}"
-                ) from err
-            function(
-                record, arg, params
-            )  # modify record in-place according to each coupon param
-    return ret
+            function = getattr(module, func_name, None)
+            if (
+                not inspect.isfunction(function)
+                or function.__module__ != module.__name__
+                or func_name.startswith(("_", "check_"))
+            ):
+                raise xc.CouponUserError(
+                    f"Invalid param {module_name}.{func_name} in {params}"
+                )
+            check = getattr(module, f"check_{func_name}", None)
+            if check is not None:
+                check(arg, params)
+            pipeline.append((function, arg))
+    return pipeline
+
+
+def _count_use(
+    session: Session, cls: type, max_count: int | None, message: str, **key
+) -> None:
+    """
+    Increment a redemption counter (keyed lookup, no count scan), raise message if it reached max_count.
+    None means unlimited: nothing to check, nothing to count.
+    A missing counter is backfilled from queue items (archived ones too) redeemed before counters existed.
+    """
+    if max_count is None:
+        return
+    where = [getattr(cls, column) == value for column, value in key.items()]
+    statement = (
+        update(cls)
+        .where(*where, cls.use_count < max_count)
+        .values(use_count=cls.use_count + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if session.execute(statement).rowcount:
+        return
+    if session.exec(select(cls).where(*where)).first() is None:
+        history = db.qitem_history(*key)
+        used_count = session.exec(
+            select(func.count()).where(
+                *[history.c[column] == value for column, value in key.items()]
+            )
+        ).one()
+        # concurrent first redemptions: one of them inserts it, all of them retry the UPDATE
+        db.insert_ignore(session, cls, [{**key, "use_count": used_count}])
+        if session.execute(statement).rowcount:
+            return
+    raise xc.CouponUserError(message)
+
+
+def create_batch(batch: bm.CreateCouponBatch) -> dict:
+    """
+    Implement POST /coupon/batch, in one transaction.
+    Names are generated in rounds: drop candidates already in use with one SELECT,
+    multi-row INSERT the rest skipping conflicts, top up the missing ones in the next round.
+    """
+    if batch.coupon_name is not None:
+        raise xc.CouponUserError("coupon_name is generated in batch")
+    if not 0 < batch.count <= settings.max_coupon_batch:
+        raise xc.CouponUserError(f"Must be 0 < count <= {settings.max_coupon_batch}")
+    free = name_pool.pool.capacity - name_pool.pool.used  # as of last refill
+    if batch.count > free:
+        # more than there are would keep drawing random names for ever
+        raise xc.CouponUserError(f"Must be count <= {free}, coupon names free")
+    # to make sure user exists in user table
+    db.get_one_record("user", "user_name", batch.user_name)
+    compile_params(batch.params)  # invalid coupons are not created
+
+    row = _coupon_dict(batch)
+    coupon_names = []
+    with Session(db.engine) as session:
+        for _ in range(NTRIES_INSERT_RAND):
+            candidates = set()
+            while len(candidates) < batch.count - len(coupon_names):
+                candidates.add(name_pool.pool.random_name())
+            candidates.difference_update(
+                session.exec(
+                    select(db.Coupon.coupon_name).where(
+                        db.Coupon.coupon_name.in_(candidates)
+                    )
+                )
+            )
+            coupon_names += _insert_new(
+                session, [{**row, "coupon_name": name} for name in candidates]
+            )
+            if len(coupon_names) == batch.count:
+                break
+        else:
+            raise xc.CouponError(
+                f"Could not generate {batch.count} coupon names in {NTRIES_INSERT_RAND} rounds"
+            )
+        session.commit()
+    cache.bump("coupon")
+    for name in coupon_names:
+        cached_coupons.invalidate(name)  # might be cached as 404
+    return {"coupon_names": coupon_names}
+
+
+def _insert_new(session: Session, rows: list[dict]) -> list[str]:
+    """Multi-row INSERT coupon rows, skip ones whose name is taken meanwhile, return names inserted"""
+    inserted = []
+    dialect = session.get_bind().dialect.name
+    for i in range(0, len(rows), INSERT_CHUNK_ROWS):
+        chunk = rows[i : i + INSERT_CHUNK_ROWS]
+        if dialect == "postgresql":
+            statement = (
+                postgresql.insert(db.Coupon)
+                .values(chunk)
+                .on_conflict_do_nothing()
+                .returning(db.Coupon.coupon_name)
+            )
+            inserted += session.execute(statement).scalars()
+        else:  # no RETURNING, see db.insert_many
+            statement = sqlite.insert(db.Coupon).values(chunk).on_conflict_do_nothing()
+            if session.execute(statement).rowcount != len(chunk):
+                raise xc.CouponError("Coupon names taken meanwhile, please try again")
+            inserted += [row["coupon_name"] for row in chunk]
+    return inserted
 
 
 def _generate_name(coupon_item: bm.CreateCoupon) -> None:
     """Update coupon_item.coupon_name in-place"""
+    coupon_item.coupon_name = name_pool.pool.pop()
+    if coupon_item.coupon_name is not None:
+        try:
+            _insert(coupon_item)
+            return
+        except IntegrityError:  # taken meanwhile, see NamePool
+            coupon_item.coupon_name = None
     for _ in range(NTRIES_INSERT_RAND):
-        coupon_item.coupon_name = "".join(
-            random.choice(settings.coupon_alphabet)
-            for _ in range(settings.coupon_name_len)
-        )
+        coupon_item.coupon_name = name_pool.pool.random_name()
         try:
             _insert(coupon_item)
             return
@@ -155,9 +511,9 @@ def _insert(coupon_item: bm.CreateCoupon) -> None:
     1. Predefined coupon name (die if already exists)
     2. Generating new coupon name (retry in a loop if already exists)
     """
-    dic = _coupon_dict(coupon_item)
-    dic["params_json"] = json.dumps(dic.pop("params"))
-    rec = db.Coupon(**dic)
+    rec = db.Coupon(**_coupon_dict(coupon_item))
     with Session(db.engine) as session:
         session.add(rec)  # might raise on conflict (dup key)
         session.commit()
+    cache.bump("coupon")
+    cached_coupons.invalidate(coupon_item.coupon_name)  # might be cached as 404
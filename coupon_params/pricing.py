@@ -1,39 +1,59 @@
-"""Modify final price according to pricing params of Coupon"""
+"""Modify final price according to pricing params of Coupon
+check_<param>(value, params) validates a param once, when the coupon is created, see coupon.compile_params
+"""
 
-from sqlmodel import Session, select
-from sqlalchemy import func
+from sqlmodel import Session
 
 import db
 import exception as xc
 from config import settings
 
 
-def percent(record: dict, value: int, params: dict) -> None:
-    """Deduct the percent (add as it's negative) from final price"""
-    if not 0 > value >= -100:
+def _is_number(value) -> bool:
+    """JSON number, not true or false, which are ints in Python"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_percent(value: int, params: dict) -> None:
+    """Validate percent"""
+    if not _is_number(value) or not 0 > value >= -100:
         raise xc.CouponUserError(f"Must be 0 > percent >= -100 in {params}")
+
+
+def percent(record: dict, value: int, params: dict, _dummy_session=None) -> None:
+    """Deduct the percent (add as it's negative) from final price"""
     record["final_price"] *= 1 + value / 100
 
 
-def frequenter_percent(record: dict, value: int, params: dict) -> None:
+check_frequenter_percent = check_percent
+
+
+def frequenter_percent(
+    record: dict, value: int, params: dict, session: Session
+) -> None:
     """Deduct the percent (add) from final price IF user has >= min_frequenter_orders completed orders"""
-    with Session(db.engine) as session:
-        n_completed_orders = session.exec(
-            select([func.count(db.Qitem.id)])
-            .where(db.Qitem.user_name == record.user_name)
-            .where(db.Qitem.completed_at is not None)
-        ).one()
-    if n_completed_orders >= settings.min_frequenter_orders:
+    if _user_stat(record, session).completed_orders >= settings.min_frequenter_orders:
         percent(record, value, params)
 
 
-def amount(record: dict, value: int, params: dict) -> None:
-    """Deduct the amount of money(add as it's negative)  from final price. Don't be negative!"""
-    if not value < 0:
+def _user_stat(record: dict, session: Session) -> db.UserStat:
+    """Statistics of the user of record, by one keyed read"""
+    return session.get(db.UserStat, record["user_name"]) or db.UserStat(
+        user_name=record["user_name"]
+    )
+
+
+def check_amount(value: int, params: dict) -> None:
+    """Validate amount, also against other pricing params"""
+    if not _is_number(value) or not value < 0:
         raise xc.CouponUserError(f"Must be value < 0 in {params}")
-    for key in params.keys():
+    for key in params.get("pricing", {}).keys():
         if "percent" in key:
             raise xc.CouponUserError(
                 f"must not use amount and percent together in {params}"
             )
+
+
+def amount(record: dict, value: int, params: dict, _dummy_session=None) -> None:
+    """Deduct the amount of money(add as it's negative)  from final price. Don't be negative!"""
     record["final_price"] = max(record["final_price"] + value, 0)
@@ -1,11 +1,27 @@
-"""Modify admission and position into queue according to queing params of Coupon"""
+"""Modify admission and position into queue according to queing params of Coupon
+check_<param>(value, params) validates a param once, when the coupon is created, see coupon.compile_params
+"""
 
+import exception as xc
 
-def vip(record: dict, value: int, _dummy_params) -> None:
+
+def check_vip(value: int, params: dict) -> None:
+    """Validate vip, a level of VIPness"""
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise xc.CouponUserError(f"Must be vip an integer >= 0 in {params}")
+
+
+def vip(record: dict, value: int, _dummy_params, _dummy_session=None) -> None:
     """Upgrade queue item to vip"""
     record["vip"] = value
 
 
-def reopen(record: dict, value: bool, _dummy_params) -> None:
+def check_reopen(value: bool, params: dict) -> None:
+    """Validate reopen"""
+    if not isinstance(value, bool):
+        raise xc.CouponUserError(f"Must be reopen true or false in {params}")
+
+
+def reopen(record: dict, value: bool, _dummy_params, _dummy_session=None) -> None:
     """Allow insert to queue even if waiting room is full (i.e. reopen door)"""
     record["_check_queue_len"] = not value
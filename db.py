@@ -1,16 +1,41 @@
 """Database schema definition and functions for project Coupon"""
 
+import argparse
 import datetime
+import itertools
+import logging
+import math
 import sys
+import threading
+import time
 from typing import Optional
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import DDL, JSON, Column, Index, event, insert, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlmodel import Field, Session, SQLModel, create_engine, select
 
+import cache
 import exception as xc
 from config import settings
 
 db = sys.modules[__name__]  # ~import sql_model (self) as db
+QUEUE_LOCK_KEY = 0x636F7570  # advisory lock key for the waiting room, "coup"
+CACHED_TABLES = {"user"}  # reference data, rows never change in this project
+cached_records = cache.new("records")
+_engine = None  # see get_engine()
+_engine_lock = threading.Lock()
+_replicas: tuple[tuple[str, ...], list["Replica"]] = ((), [])  # see get_replicas()
+_replica_turn = itertools.count()  # round robin
+# secs behind the primary, 0 if not a replica or nothing to replay
+REPLICA_LAG_SQL = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+logger = logging.getLogger(__name__)
 
 
 class User(SQLModel, table=True):
@@ -23,17 +48,29 @@ class Coupon(SQLModel, table=True):
     """Table coupon"""
 
     coupon_name: str = Field(nullable=False, primary_key=True)  # ?
-    params_json: str = Field(nullable=False, default="{}")
+    params: dict = Field(
+        default_factory=dict,
+        sa_column=Column(JSON().with_variant(JSONB, "postgresql"), nullable=False),
+    )
     max_use_count_per_user: int = Field(nullable=True, default=None)  #!!!1
     max_use_count_global: int = Field(nullable=True, default=None)  # unlimited
     user_name: Optional[str] = Field(foreign_key="user.user_name", default=None)
 
 
-class Qitem(SQLModel, table=True):
-    """Table qitem for queue items"""
+# for params @> '{"pricing": {"percent": -15}}' and params @? '$.queuing.vip', see coupon._param_filter.
+# Postgres only: elsewhere it would be a b-tree of whole JSON documents, of no use
+event.listen(
+    Coupon.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_coupon_params ON coupon USING gin (params)").execute_if(
+        dialect="postgresql"
+    ),
+)
+
+
+class QitemBase(SQLModel):
+    """Columns of queue items, waiting (qitem) or archived (qitemarchive)"""
 
-    # must keep autoincrement id for queue order
-    id: Optional[int] = Field(default=None, primary_key=True)
     created_at: Optional[datetime.datetime] = Field(
         default_factory=datetime.datetime.utcnow, nullable=False
     )
@@ -45,6 +82,79 @@ class Qitem(SQLModel, table=True):
     final_price: int = Field(nullable=False)
     # None if waiting in queue
     completed_at: Optional[datetime.datetime] = Field(default=None)
+    # worker processing it, until lease expires, see queue_item.claim
+    claimed_by: Optional[str] = Field(default=None)
+    lease_expires_at: Optional[datetime.datetime] = Field(default=None)
+
+
+class Qitem(QitemBase, table=True):
+    """Table qitem for queue items, waiting ones and ones completed but not archived yet"""
+
+    __table_args__ = (
+        # queue order of waiting items: vip desc, id; makes position a range COUNT
+        Index(
+            "ix_qitem_waiting_order",
+            text("vip DESC"),
+            "id",
+            postgresql_where=text("completed_at IS NULL"),
+            sqlite_where=text("completed_at IS NULL"),
+        ),
+        # completed items to be archived
+        Index(
+            "ix_qitem_completed",
+            "id",
+            postgresql_where=text("completed_at IS NOT NULL"),
+            sqlite_where=text("completed_at IS NOT NULL"),
+        ),
+        # SQLite would reuse the ids of archived rows at the tail, ids are keys of the order history too
+        {"sqlite_autoincrement": True},
+    )
+
+    # must keep autoincrement id for queue order
+    id: Optional[int] = Field(default=None, primary_key=True)
+
+
+class QitemArchive(QitemBase, table=True):
+    """Table qitemarchive for completed queue items moved from qitem, the order history, see archive"""
+
+    __table_args__ = (
+        # history aggregates: frequenter stats, redemption counter backfill
+        Index("ix_qitemarchive_user_name", "user_name"),
+        Index("ix_qitemarchive_coupon_user", "coupon_name", "user_name"),
+    )
+
+    id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+
+
+class UserStat(SQLModel, table=True):
+    """Statistics of a user's completed orders, updated when an order is completed"""
+
+    user_name: str = Field(primary_key=True, foreign_key="user.user_name")
+    completed_orders: int = Field(default=0, nullable=False)
+    lifetime_spend: int = Field(default=0, nullable=False)  # sum of final_price
+
+
+class CouponUse(SQLModel, table=True):
+    """Redemption counter of a coupon, global, only for coupons with max_use_count_global"""
+
+    coupon_name: str = Field(primary_key=True, foreign_key="coupon.coupon_name")
+    use_count: int = Field(default=0, nullable=False)
+
+
+class CouponUserUse(SQLModel, table=True):
+    """Redemption counter of a coupon per user, only for coupons with max_use_count_per_user"""
+
+    coupon_name: str = Field(primary_key=True, foreign_key="coupon.coupon_name")
+    user_name: str = Field(primary_key=True, foreign_key="user.user_name")
+    use_count: int = Field(default=0, nullable=False)
+
+
+def qitem_history(*keys: str):
+    """Subquery of columns keys of all queue items, archived ones too, for history aggregates"""
+    return union_all(
+        select(*[getattr(Qitem, key) for key in keys]),
+        select(*[getattr(QitemArchive, key) for key in keys]),
+    ).subquery()
 
 
 def class_of_table_name(table_name: str) -> SQLModel:
@@ -53,19 +163,39 @@ def class_of_table_name(table_name: str) -> SQLModel:
 
 
 def get_one_record(
-    table_name: str, column: str, value: str | None, strict: bool = False
+    table_name: str,
+    column: str,
+    value: str | None,
+    strict: bool = False,
+    session: Session = None,
 ):
     """Get one record from a table"""
     if value is None:
         if strict:
             raise xc.CouponUserError(f"Undefined {column}")
         return None
+    if table_name in CACHED_TABLES:  # not transactional, own session, detached record
+        return cached_records.get(
+            (table_name, column, value),
+            lambda: _get_one_record(table_name, column, value, None),
+        )
+    return _get_one_record(table_name, column, value, session)
+
+
+def _get_one_record(table_name: str, column: str, value: str, session: Session):
+    """Get one record from a table, no cache"""
     cls = class_of_table_name(table_name)
     statement = select(cls).where(getattr(cls, column) == value)
-    with Session(db.engine) as session:
-        return session.exec(statement).first() or xc.raiser(
-            xc.Coupon404(f"No such {column}")
-        )
+    if session is None:  # a miss on a replica is confirmed on the primary
+        for engine in read_engines():
+            with Session(engine) as session:
+                record = session.exec(statement).first()
+            if record is not None:
+                return record
+        raise xc.Coupon404(f"No such {column}")
+    return session.exec(statement).first() or xc.raiser(
+        xc.Coupon404(f"No such {column}")
+    )
 
 
 def add_one_record(
@@ -84,8 +214,54 @@ def add_one_record(
         session.add(record)
 
 
+def lock_queue(session: Session) -> None:
+    """
+    Serialize queue writes reading the queue first (count, then insert; select, then update)
+    until the end of the transaction of session.
+    Transaction level advisory lock on Postgres. SQLite has one writer at a time, but pysqlite begins
+    the transaction at the first write only, so reads before it are not serialized: a write of no rows
+    takes the database write lock now, like BEGIN IMMEDIATE.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": QUEUE_LOCK_KEY}
+        )
+    else:
+        session.execute(text("UPDATE qitem SET id = id WHERE 0"))
+
+
+def insert_many(session: Session, cls: SQLModel, rows: list[dict]) -> list[int]:
+    """
+    Insert rows (without id) into a table with autoincrement id by one multi-row INSERT, return ids by row.
+    SQLAlchemy 1.4 has no RETURNING for SQLite: rows are inserted one by one there, and writes needing their
+    rows back read them separately, under SQLite's write lock (one writer at a time), see lock_queue.
+    """
+    if not rows:
+        return []
+    if session.get_bind().dialect.name == "postgresql":
+        statement = insert(cls).values(rows).returning(cls.id)
+        # one statement takes ids from the sequence in VALUES order
+        return sorted(session.execute(statement).scalars())
+    records = [cls(**row) for row in rows]
+    session.add_all(records)
+    session.flush()
+    return [record.id for record in records]
+
+
+def insert_ignore(session: Session, cls: SQLModel, rows: list[dict]) -> None:
+    """
+    Multi-row INSERT rows, skip the ones whose key exists (INSERT ... ON CONFLICT DO NOTHING),
+    e.g. a counter created by a concurrent transaction meanwhile: Postgres waits for it to commit, then skips
+    """
+    if not rows:
+        return
+    dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+    session.execute(dialect.insert(cls).values(rows).on_conflict_do_nothing())
+
+
 def init():
-    """Create tables"""
+    """Create tables missing, then add initial records missing"""
+    SQLModel.metadata.create_all(db.engine)
     with Session(db.engine) as session:
         try:
             for table_name, records in settings.init_db_records.items():
@@ -108,8 +284,17 @@ def delete_from_variable_tables():
     https://github.com/tiangolo/sqlmodel/issues/181#issuecomment-992416067
     "now I can see only single object-level deletes"
     """
+    cache.clear_all()
     with Session(db.engine) as session:
-        for cls in [db.Qitem, db.Coupon]:  # order is important
+        # order is important
+        for cls in [
+            db.Qitem,
+            db.QitemArchive,
+            db.UserStat,
+            db.CouponUserUse,
+            db.CouponUse,
+            db.Coupon,
+        ]:
             statement = select(cls)
             results = session.exec(statement)
             for record in results:
@@ -122,7 +307,15 @@ def XXdelete_from_variable_tables():
     i.e Delete all Coupons and Queue Items
     """
     with Session(db.engine) as session:
-        for cls in [db.Qitem, db.Coupon]:  # order is important
+        # order is important
+        for cls in [
+            db.Qitem,
+            db.QitemArchive,
+            db.UserStat,
+            db.CouponUserUse,
+            db.CouponUse,
+            db.Coupon,
+        ]:
             delete_results(session, session.exec(select(cls)))
         session.commit()
 
@@ -136,10 +329,165 @@ def delete_results(session, results) -> None:
         session.delete(record)
 
 
-engine = create_engine(settings.db_url)
-SQLModel.metadata.create_all(db.engine)
+class MeteredQueuePool(QueuePool):
+    """QueuePool that also counts checkouts, waiting threads and time spent getting a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_secs = 0.0
+        self.max_checkout_secs = 0.0
+
+    def connect(self):
+        with self.stats_lock:
+            self.waiting += 1
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            secs = time.perf_counter() - start
+            with self.stats_lock:
+                self.waiting -= 1
+                self.checkouts += 1
+                self.checkout_secs += secs
+                self.max_checkout_secs = max(self.max_checkout_secs, secs)
+
+
+def engine_kwargs(url: str) -> dict:
+    """create_engine() arguments from settings"""
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # in-memory DB lives as long as its only connection, shared by all threads (tests)
+        return dict(poolclass=StaticPool, connect_args={"check_same_thread": False})
+    kwargs = dict(
+        poolclass=MeteredQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        pool_recycle=settings.db_pool_recycle,
+    )
+    backend = url.get_backend_name()
+    if backend == "postgresql" and settings.db_statement_timeout:
+        kwargs["connect_args"] = {
+            "options": f"-c statement_timeout={settings.db_statement_timeout}"
+        }
+    elif backend == "sqlite":  # connections are shared by threads via the pool
+        kwargs["connect_args"] = {"check_same_thread": False}
+    return kwargs
+
+
+def pool_status() -> dict:
+    """Implement GET /db/pool"""
+    pool = db.engine.pool
+    if not isinstance(pool, MeteredQueuePool):
+        return {"pool": pool.status()}
+    with pool.stats_lock:
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "waiting": pool.waiting,
+            "checkouts": pool.checkouts,
+            "avg_checkout_ms": 1000 * pool.checkout_secs / max(pool.checkouts, 1),
+            "max_checkout_ms": 1000 * pool.max_checkout_secs,
+        }
+
+
+def get_engine():
+    """Engine of settings.db_url, created at first use (it connects only when used, too)"""
+    global _engine  # pylint: disable=global-statement
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    settings.db_url, **engine_kwargs(settings.db_url)
+                )
+    return _engine
+
+
+class Replica:
+    """Reader engine of a read replica, with its replication lag as measured lately"""
+
+    def __init__(self, url: str):
+        self.engine = create_engine(url, **engine_kwargs(url))
+        self.lag = 0.0  # secs
+        self._checked_at = -math.inf
+        self._lock = threading.Lock()
+
+    def fresh_enough(self) -> bool:
+        """Lag is within settings.db_replica_max_lag, measured at most every db_replica_lag_check secs"""
+        now = time.monotonic()
+        with self._lock:
+            check = now - self._checked_at >= settings.db_replica_lag_check
+            if check:  # others go on with the lag measured last time
+                self._checked_at = now
+        if check:
+            self.lag = self._measure_lag()
+        return self.lag <= settings.db_replica_max_lag
+
+    def _measure_lag(self) -> float:
+        if self.engine.dialect.name != "postgresql":
+            return 0.0  # no replication to measure, e.g. a local database in tests
+        try:
+            with self.engine.connect() as conn:
+                return float(conn.execute(text(REPLICA_LAG_SQL)).scalar() or 0)
+        except SQLAlchemyError:
+            logger.exception("Could not measure lag of replica %s", self.engine.url)
+            return math.inf
+
+
+def get_replicas() -> list[Replica]:
+    """Replicas of settings.db_replica_urls, created at first use or when the setting changes"""
+    global _replicas  # pylint: disable=global-statement
+    urls = tuple(settings.db_replica_urls)
+    if _replicas[0] != urls:
+        with _engine_lock:
+            if _replicas[0] != urls:
+                _replicas = (urls, [Replica(url) for url in urls])
+    return _replicas[1]
+
+
+def read_engines(fresh: bool = False) -> list:
+    """
+    Engines to read from, in order: a replica fresh enough (round robin), then the primary.
+    Only the primary if fresh, i.e. the reader must see writes committed just before (read-your-writes).
+    Writes, and reads in their transaction like limit checks, use db.engine, i.e. the primary.
+    """
+    if fresh:
+        return [db.engine]
+    replicas = get_replicas()
+    turn = next(_replica_turn)
+    for i in range(len(replicas)):
+        replica = replicas[(turn + i) % len(replicas)]
+        if replica.fresh_enough():
+            return [replica.engine, db.engine]
+    return [db.engine]
+
+
+def reader(fresh: bool = False):
+    """Engine to read lists and counts from, see read_engines()"""
+    return read_engines(fresh)[0]
+
+
+def __getattr__(name: str):
+    """db.engine is get_engine(), so importing db has no side effects"""
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main() -> None:
+    """Command line: create (and seed) or drop tables of settings.db_url, not to do it at app startup"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("command", choices=["init", "drop"])
+    if parser.parse_args().command == "drop":
+        drop_all()
+    else:
+        init()
+
 
-if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "--drop":
-    drop_all()
-else:
-    init()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""In-process change feed of the waiting queue for project Coupon, pushing position updates to subscribers"""
+import asyncio
+import itertools
+import json
+import math
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterable
+
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+import cache
+import exception as xc
+from config import settings
+
+# Guards the state below, held to register and publish writes, never while waiting for the DB.
+# Writes are committed outside of it, so concurrent ones may be published in another order than
+# committed: deltas are counts, their order does not matter.
+_lock = threading.Lock()
+_subscriptions: set["Subscription"] = set()
+# items of writes being committed, not published yet, by write number
+_committing: dict[int, list[dict]] = {}
+_catch_ups: set["_CatchUp"] = set()  # of snapshots being taken
+_write_numbers = itertools.count()
+
+# snapshot(ambiguous) of DB, see Subscription
+State = tuple[int, int, int | None]
+Snapshot = Callable[[Callable[[], set[int]]], tuple[State, dict[int, bool]]]
+
+
+class Subscription:
+    """
+    Queue position (and queue length) of a waiting item, kept up to date by deltas, pushed to an asyncio queue.
+    Its state comes from snapshot(ambiguous), reading in one DB snapshot: (vip, queue position, queue length
+    or None) of the item (Coupon404 if not waiting), and of the ids returned by ambiguous() (called after the
+    first read) whether each of them was completed (True) or waiting (False) then, leaving out ones it did not
+    see yet. These are the items of writes committed around the snapshot: deltas of the ones seen are not
+    applied again, see apply().
+    """
+
+    def __init__(
+        self, qitem_id: int, loop: asyncio.AbstractEventLoop, snapshot: Snapshot
+    ):
+        self.qitem_id = qitem_id
+        self.loop = loop
+        self.snapshot = snapshot
+        self.vip, self.queue_position, self.queue_len = 0, None, None
+        self.seen: dict[int, bool] = {}  # by the snapshot: completed, by id
+        self.last_event: dict | None = None  # pushed
+        self.events: asyncio.Queue[dict] = asyncio.Queue()
+
+    def event(self) -> dict:
+        """Current state as pushed"""
+        event = {"id": self.qitem_id, "queue_position": self.queue_position}
+        if self.queue_len is not None:
+            event["queue_len"] = self.queue_len
+        return event
+
+    def _ahead(self, item: dict) -> bool:
+        return item["vip"] > self.vip or (
+            item["vip"] == self.vip and item["id"] < self.qitem_id
+        )
+
+    def reset(self, state: State, seen: dict[int, bool]) -> None:
+        """Set state as of a snapshot"""
+        self.vip, self.queue_position, self.queue_len = state
+        self.seen = seen
+
+    def apply(self, added: list[dict], removed: list[dict]) -> None:
+        """Apply changes of the queue, but ones the snapshot has already"""
+        added = [item for item in added if item["id"] not in self.seen]
+        removed = [item for item in removed if not self.seen.get(item["id"], False)]
+        if self.queue_len is not None:
+            self.queue_len += len(added) - len(removed)
+        if self.queue_position is None:
+            return
+        if any(item["id"] == self.qitem_id for item in removed):
+            self.queue_position = None  # not waiting any more
+            return
+        self.queue_position += sum(map(self._ahead, added)) - sum(
+            map(self._ahead, removed)
+        )
+
+    def push(self) -> None:
+        """Push current state if changed, under _lock, so pushes are in the order of changes"""
+        event = self.event()
+        if event == self.last_event:
+            return
+        self.last_event = event
+        if event["queue_position"] is None:
+            _subscriptions.discard(self)
+        try:  # handlers are threaded, subscribers are waiting in the event loop
+            self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+        except RuntimeError:  # loop closed
+            _subscriptions.discard(self)
+
+
+class _CatchUp:  # pylint: disable=too-few-public-methods
+    """Writes published while a snapshot is being taken"""
+
+    def __init__(self):
+        self.writes: list[tuple[list[dict], list[dict]]] = []
+
+
+def subscribe(
+    qitem_id: int, loop: asyncio.AbstractEventLoop, snapshot: Snapshot
+) -> Subscription:
+    """Subscribe to changes of a waiting item, starting from snapshot(), which raises Coupon404 if not waiting"""
+    subscription = Subscription(qitem_id, loop, snapshot)
+    sync(subscription)
+    return subscription
+
+
+def sync(subscription: Subscription) -> None:
+    """
+    (Re)set the state of subscription from its snapshot, then apply the writes published meanwhile, and push it.
+    No lock is held while reading DB: writes committed around the snapshot are told apart by subscription.seen.
+    Resyncing repairs drift, e.g. by writes of other worker processes, which are not published here.
+    """
+    catch_up = _CatchUp()
+    with _lock:
+        _catch_ups.add(catch_up)
+    try:
+
+        def ambiguous() -> set[int]:
+            with _lock:
+                writes = [added + removed for added, removed in catch_up.writes]
+                writes += _committing.values()
+            return {item["id"] for items in writes for item in items}
+
+        try:
+            state, seen = subscription.snapshot(ambiguous)
+        except xc.Coupon404:
+            if subscription.last_event is None:  # subscribing
+                raise
+            state, seen = (subscription.vip, None, subscription.queue_len), {}
+        with _lock:
+            _catch_ups.discard(catch_up)
+            subscription.reset(state, seen)
+            for added, removed in catch_up.writes:
+                subscription.apply(added, removed)
+            if subscription.queue_position is not None:
+                _subscriptions.add(subscription)
+            subscription.push()
+    finally:
+        with _lock:
+            _catch_ups.discard(catch_up)
+
+
+def unsubscribe(subscription: Subscription) -> None:
+    """Stop pushing to subscription"""
+    with _lock:
+        _subscriptions.discard(subscription)
+
+
+def commit(
+    session: Session, added: Iterable[dict] = (), removed: Iterable[dict] = ()
+) -> None:
+    """
+    Commit session, then publish items (dicts having id and vip) added to and removed from the waiting queue,
+    also as a new version of qitem (for responses cached by version)
+    """
+    added, removed = list(added), list(removed)
+    with _lock:  # so snapshots taken meanwhile know these might be in them
+        write = next(_write_numbers)
+        _committing[write] = added + removed
+    try:
+        session.commit()
+        cache.bump("qitem")
+    except BaseException:
+        with _lock:
+            del _committing[write]
+        raise
+    with _lock:  # committing or published, never neither, as seen by snapshots
+        del _committing[write]
+        for catch_up in _catch_ups:
+            catch_up.writes.append((added, removed))
+        for subscription in list(_subscriptions):
+            subscription.apply(added, removed)
+            subscription.push()
+
+
+async def sse_events(subscription: Subscription) -> AsyncIterator[str]:
+    """
+    Server-Sent Events of subscription: position now, then on each change, until it is not waiting any more.
+    Resynced from DB every settings.sse_resync secs.
+    """
+    try:
+        resync_at = _resync_at()
+        while True:
+            now = time.monotonic()
+            if now >= resync_at:
+                await run_in_threadpool(sync, subscription)
+                resync_at = _resync_at()
+                continue
+            try:
+                event = await asyncio.wait_for(
+                    subscription.events.get(),
+                    min(settings.sse_keepalive, resync_at - now),
+                )
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"  # comment, keeps proxies from closing the connection
+                continue
+            done = event["queue_position"] is None
+            yield f"event: {'done' if done else 'position'}\ndata: {json.dumps(event)}\n\n"
+            if done:
+                return
+    finally:
+        unsubscribe(subscription)
+
+
+def _resync_at() -> float:
+    return time.monotonic() + (settings.sse_resync or math.inf)
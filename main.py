@@ -1,18 +1,114 @@
 """Application for project Coupon"""
+import asyncio
+import hashlib
 import os
 import sys
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from typing import Callable, Iterator
+from fastapi import FastAPI, Path, Query, Request
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.concurrency import run_in_threadpool
 
+import archive
 import base_model as bm
+import cache
 import coupon
+import db
 import exception as xc
+import feed
+import metrics
+import name_pool
+import profiler
 import queue_item
+import serialize
+from config import settings
 
 app_dir = os.path.join(os.path.dirname(__file__))
 sys.path.append(app_dir)
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiler.ProfilerMiddleware)
+
+# Endpoints calling the (synchronous, DB bound) service layer are plain def, not async def:
+# FastAPI runs them in its threadpool, so a slow query does not stall the event loop.
+# Event streams are async def, waiting for the change feed in the event loop, not a thread each.
+
+
+@app.on_event("startup")
+def init_db() -> None:
+    """Create tables and initial records missing (first of the startup handlers)"""
+    if settings.db_init_on_startup:
+        db.init()
+
+
+@app.on_event("startup")
+def load_queue_engine() -> None:
+    """Mirror the waiting queue in memory, if enabled"""
+    queue_item.load_engine()
+
+
+@app.on_event("startup")
+def fill_name_pool() -> None:
+    """Have free coupon names ready"""
+    name_pool.pool.start_refill()
+
+
+@app.on_event("startup")
+def start_archiving() -> None:
+    """Move completed queue items to the archive in background, if enabled"""
+    archive.start()
+
+
+listings = cache.Cache(
+    "listings", settings.listing_cache_maxsize, settings.listing_cache_ttl, 0
+)
+
+
+def etag_response(
+    request: Request,
+    table_name: str,
+    params: tuple,
+    build: Callable[[], dict],
+    fresh: bool = False,
+):
+    """
+    JSON response of build() with an ETag, 304 Not Modified if the client has it already (If-None-Match).
+    The body is cached per path, params (the query params build() uses) and version of table_name,
+    so a repeated GET costs no query, no encoding; unless it's bigger than settings.listing_cache_max_body.
+    Not cached if fresh: the client is to see writes by any worker process right away.
+    """
+    if fresh:
+        etag, body = _etag_body(build())
+    else:
+        etag, body = listings.get(
+            (request.url.path, params, cache.version(table_name)),
+            lambda: _etag_body(build()),
+            keep=lambda etag_body: len(etag_body[1]) <= settings.listing_cache_max_body,
+        )
+    headers = {"ETag": etag}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _etag_body(content: dict) -> tuple[str, bytes]:
+    """ETag by content (not by version, which is per process) and the JSON body"""
+    body = serialize.json_body(content)
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body
+
+
+def ndjson_response(records: Iterator[dict]) -> StreamingResponse:
+    """Stream records as newline delimited JSON, one record per line"""
+    return StreamingResponse(
+        (serialize.ndjson_line(record) for record in records),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.exception_handler(xc.Coupon404)
@@ -52,42 +148,172 @@ async def exception_handler_503(_: Request, err: Exception) -> JSONResponse:
 
 
 @app.post("/coupon")
-async def create_coupon(coupon_item: bm.CreateCoupon):
+def create_coupon(coupon_item: bm.CreateCoupon):
     """create coupon"""
     return coupon.create(coupon_item)
 
 
+@app.post("/coupon/batch")
+def create_coupon_batch(batch: bm.CreateCouponBatch):
+    """create count coupons alike, with generated coupon_name"""
+    return coupon.create_batch(batch)
+
+
 @app.get("/coupon")
-async def list_coupons():
-    """list all coupons"""
-    return coupon.get_all()
+def list_coupons(
+    request: Request,
+    after: str | None = None,
+    limit: int | None = Query(default=None, gt=0),
+    param: str | None = Query(default=None, example="queuing.vip"),
+    value: str | None = Query(default=None, example="1"),
+    format_: str = Query(
+        default="json", alias="format", regex="^(json|ndjson|columnar)$"
+    ),
+    fresh: bool = False,
+):
+    """list all coupons, or a page of limit coupons after coupon_name after, optionally having param (with value)
+    format: json, ndjson (streamed, one coupon per line) or columnar (one list per field)
+    fresh: from the primary database, not a read replica, to see writes just done
+    """
+    if format_ == "ndjson":
+        return ndjson_response(coupon.stream_all(after, limit, param, value, fresh))
+    return etag_response(
+        request,
+        "coupon",
+        (after, limit, param, value, format_),
+        lambda: coupon.get_all(
+            after, limit, param, value, fresh, columnar=format_ == "columnar"
+        ),
+        fresh,
+    )
+
+
+@app.get("/coupon_namespace")
+def get_coupon_namespace():
+    """Return how much of the namespace of generated coupon names is used"""
+    return name_pool.pool.status()
 
 
 @app.get("/coupon/{coupon_name}")
-async def get_coupon(coupon_name: str):
+def get_coupon(coupon_name: str):
     """read coupon"""
     return coupon.get_by_name(coupon_name)
 
 
 @app.post("/queue")
-async def create_qitem(qitem: bm.CreateQitem):
+def create_qitem(qitem: bm.CreateQitem):
     """create queue (order), optionally using a coupon"""
     return queue_item.create(qitem)
 
 
+@app.post("/queue/batch")
+def create_qitem_batch(qitems: list[bm.CreateQitem]):
+    """create many queue items (orders) at once, results in input order"""
+    return queue_item.create_batch(qitems)
+
+
 @app.get("/queue")
-async def list_qitems():
-    """list all items in queue"""
-    return queue_item.get_all()
+def list_qitems(
+    request: Request,
+    after: str | None = None,
+    limit: int | None = Query(default=None, gt=0),
+    format_: str = Query(
+        default="json", alias="format", regex="^(json|ndjson|columnar)$"
+    ),
+    fresh: bool = False,
+):
+    """list all items in queue, or a page of limit items after cursor after (see next in previous page)
+    format: json, ndjson (streamed, one item per line) or columnar (one list per field)
+    fresh: from the primary database, not a read replica, to see writes just done
+    """
+    if format_ == "ndjson":
+        return ndjson_response(queue_item.stream_all(after, limit, fresh))
+    return etag_response(
+        request,
+        "qitem",
+        (after, limit, format_),
+        lambda: queue_item.get_all(after, limit, fresh, columnar=format_ == "columnar"),
+        fresh,
+    )
 
 
 @app.get("/queue/len")
-async def get_qlen():
-    """ "Return the number of not completed items in the queue"""
-    return queue_item.get_len()
+def get_qlen(fresh: bool = False):
+    """ "Return the number of not completed items in the queue
+    fresh: from the primary database, not a read replica, to see writes just done
+    """
+    return queue_item.get_len(fresh=fresh)
+
+
+@app.get("/queue/{qitem_id}/position")
+def get_qitem_position(qitem_id: int):
+    """Return the position of a not completed item in the queue, 0 is next"""
+    return queue_item.get_position(qitem_id)
+
+
+@app.get("/queue/{qitem_id}/events")
+async def stream_qitem_position(qitem_id: int, queue_len: bool = False):
+    """push the position (and queue length) of a waiting item as Server-Sent Events, till it's not waiting any more"""
+    subscription = await run_in_threadpool(
+        queue_item.subscribe, qitem_id, asyncio.get_running_loop(), queue_len
+    )
+    return StreamingResponse(
+        feed.sse_events(subscription), media_type="text/event-stream"
+    )
+
+
+@app.post("/queue/consume/{count}")
+def consume_qitems(count: int = Path(gt=0)):
+    """mark the first {count} queue items completed and return them, to consume from the queue"""
+    return queue_item.consume(count)
+
+
+@app.post("/queue/claim")
+def claim_qitems(lease: bm.ClaimQitems):
+    """lease the first {count} queue items not leased to anyone to {worker}"""
+    return queue_item.claim(lease)
+
+
+@app.put("/queue/{qitem_id}/lease")
+def extend_qitem_lease(qitem_id: int, lease: bm.Lease):
+    """extend the lease of {worker} on a claimed queue item (heartbeat)"""
+    return queue_item.extend_lease(qitem_id, lease)
+
+
+@app.post("/queue/{qitem_id}/complete")
+def complete_qitem(qitem_id: int, lease: bm.Lease):
+    """mark a queue item claimed by {worker} completed"""
+    return queue_item.complete(qitem_id, lease)
+
+
+@app.post("/queue/archive")
+def archive_qitems(batch_size: int | None = Query(default=None, gt=0)):
+    """move completed queue items to the archive, in batches"""
+    return {"archived": archive.archive(batch_size)}
 
 
 @app.put("/queue/shift/{count}")
-async def shift_qitems(count: int):
+def shift_qitems(count: int = Path(gt=0)):
     """shift {count} queue items, for testing only to consume from the queue"""
     return queue_item.shift(count)
+
+
+@app.get("/db/pool")
+def get_pool_status():
+    """Return connection pool statistics of this worker process"""
+    return db.pool_status()
+
+
+@app.get("/cache")
+def get_cache_stats():
+    """Return cache statistics of this worker process"""
+    return cache.stats()
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Return metrics of this worker process (queue length of all) in Prometheus text format"""
+    metrics.queue_len.set_all(
+        {(str(vip),): count for vip, count in queue_item.get_len_by_vip().items()}
+    )
+    return PlainTextResponse(metrics.exposition(), media_type=metrics.CONTENT_TYPE)
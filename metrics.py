@@ -0,0 +1,219 @@
+"""Prometheus style metrics of project Coupon, per worker process, in text exposition format"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)  # secs
+# status of main.exception_handler_503: it's the outermost middleware, so the error passes this one
+UNHANDLED_STATUS = 503
+UNMATCHED_ROUTE = "unmatched"  # no path of unknown URLs in labels, they are unbounded
+
+metrics: list["Metric"] = []
+# DB secs of the request being handled, a list so the threadpool (copied context) can add to it
+_request_db_secs: ContextVar[list[float] | None] = ContextVar(
+    "request_db_secs", default=None
+)
+
+
+class Metric:
+    """A metric family: values by label values, updated under a lock"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        metrics.append(self)
+
+    def _label_str(self, values: tuple, *extra: str) -> str:
+        pairs = [
+            f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)
+        ]
+        pairs += extra
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{self._label_str(values)} {value}" for values, value in items
+        ]
+
+    def lines(self) -> list[str]:
+        """Exposition of the family"""
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+
+class Counter(Metric):
+    """Monotonic counter"""
+
+    kind = "counter"
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        """Add amount to the counter of label values"""
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    """Value sampled when scraped"""
+
+    kind = "gauge"
+
+    def set_all(self, values: dict[tuple, float]) -> None:
+        """Replace all values, label values not given are gone"""
+        with self._lock:
+            self._values = dict(values)
+
+
+class Histogram(Metric):
+    """Bucketed distribution with sum and count"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_, labels)
+        self.buckets = buckets
+
+    def observe(self, amount: float, *values: str) -> None:
+        """Count amount in its bucket of label values"""
+        i = bisect.bisect_left(self.buckets, amount)  # first bucket with amount <= le
+        with self._lock:
+            counts = self._values.get(values)
+            if counts is None:  # bucket counts (not cumulative), +Inf, sum
+                counts = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(
+                (values, list(counts)) for values, counts in self._values.items()
+            )
+        samples = []
+        for values, counts in items:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                le_label = f'le="{bound}"'
+                samples.append(
+                    f"{self.name}_bucket{self._label_str(values, le_label)} {cumulative}"
+                )
+            samples.append(f"{self.name}_sum{self._label_str(values)} {counts[-1]}")
+            samples.append(f"{self.name}_count{self._label_str(values)} {cumulative}")
+        return samples
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_secs = Histogram(
+    "coupon_http_request_duration_seconds",
+    "HTTP request latency",
+    ("method", "route", "status"),
+)
+request_db_secs = Histogram(
+    "coupon_http_request_db_seconds",
+    "Time spent in DB statements per HTTP request",
+    ("method", "route", "status"),
+)
+queue_len = Gauge("coupon_queue_length", "Queue items waiting, per VIP level", ("vip",))
+redemptions = Counter(
+    "coupon_redemptions_total", "Queue items placed using a coupon", ("coupon_name",)
+)
+rejections = Counter(
+    "coupon_rejections_total", "Queue items rejected, per reason", ("reason",)
+)
+
+
+def exposition() -> str:
+    """Implement GET /metrics"""
+    return "\n".join(line for metric in metrics for line in metric.lines()) + "\n"
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """ASGI middleware timing each HTTP request, and its DB statements, by route and status"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: dict | None = None  # route path by endpoint
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = UNHANDLED_STATUS
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        db_secs = [0.0]
+        token = _request_db_secs.set(db_secs)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            secs = time.perf_counter() - start
+            _request_db_secs.reset(token)
+            labels = (scope["method"], self._route(scope), str(status))
+            request_secs.observe(secs, *labels)
+            request_db_secs.observe(db_secs[0], *labels)
+
+    def _route(self, scope) -> str:
+        """Path template of the route matched (the router set endpoint in scope)"""
+        if self._routes is None:  # all routes are added by the first request
+            self._routes = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint")
+            }
+        return self._routes.get(scope.get("endpoint"), UNMATCHED_ROUTE)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, *_) -> None:
+    if _request_db_secs.get() is not None:
+        conn.info["metrics_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, *_) -> None:
+    db_secs = _request_db_secs.get()
+    if db_secs is not None and "metrics_start" in conn.info:
+        db_secs[0] += time.perf_counter() - conn.info.pop("metrics_start")
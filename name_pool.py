@@ -0,0 +1,135 @@
+"""Coupon name namespace occupancy and pool of free coupon names for project Coupon"""
+import collections
+import logging
+import random
+import threading
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+import db
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class NamePool:
+    """
+    Names checked to be free, ready to be popped in O(1) when a coupon name is to be generated.
+    Refilled in a background thread when running low. Tracks how much of the namespace of
+    names of name_len is used, warns when it gets crowded and makes names longer before random
+    names start colliding often. Per worker process: a pooled name might still be taken
+    meanwhile (by another worker or by a coupon created with that name), so inserting must not
+    assume it is free.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names: collections.deque[str] = collections.deque()
+        self._refilling = False
+        self.name_len = settings.coupon_name_len
+        self.used = 0  # coupons with names of name_len, as of last refill
+
+    @property
+    def capacity(self) -> int:
+        """Number of possible names of name_len"""
+        return len(settings.coupon_alphabet) ** self.name_len
+
+    def random_name(self) -> str:
+        """Random coupon name, maybe in use already"""
+        return "".join(
+            random.choice(settings.coupon_alphabet) for _ in range(self.name_len)
+        )
+
+    def pop(self) -> str | None:
+        """A free name, None if the pool is empty; start refilling if running low"""
+        with self._lock:
+            name = self._names.popleft() if self._names else None
+            low = len(self._names) < settings.coupon_name_pool_low
+        if low:
+            self.start_refill()
+        return name
+
+    def start_refill(self) -> None:
+        """Refill in background, unless already refilling"""
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill_logged, daemon=True).start()
+
+    def _refill_logged(self) -> None:
+        try:
+            self.refill()
+        except Exception:  # pylint: disable=broad-exception-caught
+            # background thread, nobody else to tell
+            logger.exception("Could not refill coupon name pool")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def refill(self) -> None:
+        """Top up the pool with names checked against coupon table by one SELECT"""
+        with Session(db.engine) as session:
+            self._check_occupancy(session)
+            with self._lock:
+                pooled = set(self._names)
+            # never try to find more free names than half of those left
+            wanted = min(
+                settings.coupon_name_pool_size, (self.capacity - self.used) // 2
+            )
+            candidates = set()
+            while len(candidates) < wanted - len(pooled):
+                name = self.random_name()
+                if name not in pooled:
+                    candidates.add(name)
+            candidates.difference_update(
+                session.exec(
+                    select(db.Coupon.coupon_name).where(
+                        db.Coupon.coupon_name.in_(candidates)
+                    )
+                )
+            )
+        with self._lock:
+            self._names.extend(
+                name for name in candidates if len(name) == self.name_len
+            )
+
+    def _check_occupancy(self, session: Session) -> None:
+        """Count names used, warn or grow name_len if too many"""
+        self.used = session.exec(
+            select(func.count(db.Coupon.coupon_name)).where(
+                func.length(db.Coupon.coupon_name) == self.name_len
+            )
+        ).one()
+        occupancy = self.used / self.capacity
+        if occupancy >= settings.coupon_namespace_grow:
+            logger.warning(
+                "Coupon namespace of length %d is %.0f%% used, growing length",
+                self.name_len,
+                100 * occupancy,
+            )
+            with self._lock:
+                self.name_len += 1
+                self._names.clear()
+            self._check_occupancy(session)
+        elif occupancy >= settings.coupon_namespace_warn:
+            logger.warning(
+                "Coupon namespace of length %d is %.0f%% used",
+                self.name_len,
+                100 * occupancy,
+            )
+
+    def status(self) -> dict:
+        """Implement GET /coupon_namespace, occupancy as of last refill, no query"""
+        return {
+            "name_len": self.name_len,
+            "capacity": self.capacity,
+            "used": self.used,
+            "free": self.capacity - self.used,
+            "occupancy": self.used / self.capacity,
+            "pool_size": len(self._names),
+        }
+
+
+pool = NamePool()
@@ -0,0 +1,98 @@
+"""Opt-in per-request SQL profiler of project Coupon: statement count, DB time, slowest statements"""
+import heapq
+import logging
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+STATEMENTS_HEADER = "x-sql-statements"
+DB_MS_HEADER = "x-sql-time-ms"
+
+# profile of the request being handled, the threadpool (copied context) adds to the same object
+_profile: ContextVar["Profile | None"] = ContextVar("sql_profile", default=None)
+
+
+class Profile:
+    """SQL statements of one request"""
+
+    def __init__(self):
+        self.statements = 0
+        self.secs = 0.0
+        self.slowest: list[
+            tuple[float, int, str]
+        ] = []  # min heap of (secs, seq, statement)
+
+    def add(self, statement: str, secs: float) -> None:
+        """Count a statement executed"""
+        self.statements += 1
+        self.secs += secs
+        entry = (secs, self.statements, statement)
+        if len(self.slowest) < settings.sql_profile_slowest:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and secs > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def headers(self) -> list[tuple[bytes, bytes]]:
+        """Response headers, as of now"""
+        return [
+            (STATEMENTS_HEADER.encode(), str(self.statements).encode()),
+            (DB_MS_HEADER.encode(), f"{1000 * self.secs:.3f}".encode()),
+        ]
+
+
+class ProfilerMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    ASGI middleware profiling SQL of each HTTP request if settings.sql_profile:
+    count and DB time in response headers (as of response start, so without the rest of a stream),
+    all of them and the slowest statements in a debug log when the request is done
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.sql_profile:
+            await self.app(scope, receive, send)
+            return
+        profile = Profile()
+
+        async def send_headers(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *profile.headers()]
+            await send(message)
+
+        token = _profile.set(profile)
+        try:
+            await self.app(scope, receive, send_headers)
+        finally:
+            _profile.reset(token)
+            logger.debug(
+                "%s %s: %d SQL statements in %.3f ms, slowest: %s",
+                scope["method"],
+                scope["path"],
+                profile.statements,
+                1000 * profile.secs,
+                [
+                    (f"{1000 * secs:.3f} ms", statement)
+                    for secs, _, statement in sorted(profile.slowest, reverse=True)
+                ],
+            )
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, *_) -> None:
+    if _profile.get() is not None:
+        conn.info["profiler_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, _cursor, statement, *_) -> None:
+    profile = _profile.get()
+    if profile is not None and "profiler_start" in conn.info:
+        profile.add(statement, time.perf_counter() - conn.info.pop("profiler_start"))
@@ -0,0 +1,129 @@
+"""In-process mirror of the waiting queue for project Coupon"""
+import bisect
+import threading
+from typing import Iterable, Iterator
+
+from config import settings
+
+COMPACT_MIN_HEAD = 1024  # don't bother moving memory for fewer shifted ids
+
+
+class _Level:
+    """Waiting ids of one VIP level, sorted, in a plain array whose head moves on shift"""
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.head = 0  # ids[:head] are gone already
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.head
+
+    def add(self, qitem_id: int) -> None:
+        """Ids are autoincrement, so this is almost always an append"""
+        if not self.ids or self.ids[-1] < qitem_id:
+            self.ids.append(qitem_id)
+        else:
+            bisect.insort(self.ids, qitem_id, lo=self.head)
+
+    def index(self, qitem_id: int) -> int | None:
+        """0-based position of qitem_id within this level, None if not here"""
+        i = bisect.bisect_left(self.ids, qitem_id, lo=self.head)
+        if i < len(self.ids) and self.ids[i] == qitem_id:
+            return i - self.head
+        return None
+
+    def remove(self, qitem_id: int) -> None:
+        """Remove qitem_id, O(1) if it is the head, which is the normal case"""
+        i = self.index(qitem_id)
+        if i is None:
+            return
+        if i == 0:
+            self.head += 1
+            if self.head >= COMPACT_MIN_HEAD and self.head * 2 >= len(self.ids):
+                del self.ids[: self.head]
+                self.head = 0
+        else:
+            del self.ids[self.head + i]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids[self.head :])
+
+
+class QueueEngine:
+    """
+    Waiting queue items kept in memory, in queue order (vip desc, id).
+    The DB is the source of truth: load() from it at startup, then the service layer writes through.
+    Writes through come after commit, by concurrent threads, so not necessarily in commit order:
+    an item might be removed before it's added, then it's remembered not to be added (tombstone).
+    Only consistent when a single process writes the queue.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._levels: dict[int, _Level] = {}
+        self._items: dict[int, dict] = {}
+        self._removed: set[int] = set()  # tombstones: ids removed before added
+
+    def load(self, items: Iterable[dict]) -> None:
+        """Replace contents with items (dicts having at least id and vip)"""
+        with self._lock:
+            self._levels = {}
+            self._items = {}
+            self._removed = set()
+            for item in items:
+                self._add(item)
+
+    def add(self, item: dict) -> None:
+        """Add a new waiting item"""
+        with self._lock:
+            self._add(item)
+
+    def _add(self, item: dict) -> None:
+        if item["id"] in self._removed:  # completed already
+            self._removed.discard(item["id"])
+            return
+        self._items[item["id"]] = item
+        self._levels.setdefault(item["vip"], _Level()).add(item["id"])
+
+    def remove(self, qitem_ids: Iterable[int]) -> None:
+        """Remove items which are no more waiting"""
+        with self._lock:
+            for qitem_id in qitem_ids:
+                item = self._items.pop(qitem_id, None)
+                if item is None:  # not added yet
+                    self._removed.add(qitem_id)
+                else:
+                    self._levels[item["vip"]].remove(qitem_id)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def position(self, qitem_id: int) -> int | None:
+        """0-based queue position, None if not waiting"""
+        with self._lock:
+            item = self._items.get(qitem_id)
+            if item is None:
+                return None
+            vip = item["vip"]
+            return sum(
+                len(level) for lvip, level in self._levels.items() if lvip > vip
+            ) + self._levels[vip].index(qitem_id)
+
+    def items(self, count: int | None = None) -> list[dict]:
+        """First count (None: all) waiting items in queue order"""
+        with self._lock:
+            ret = []
+            for vip in sorted(self._levels, reverse=True):
+                for qitem_id in self._levels[vip]:
+                    if count is not None and len(ret) >= count:
+                        return ret
+                    ret.append(self._items[qitem_id])
+            return ret
+
+
+queue = QueueEngine()
+
+
+def enabled() -> bool:
+    """Whether reads are served from memory"""
+    return settings.queue_engine
@@ -1,20 +1,170 @@
 """Queue service layer for project Coupon"""
+import asyncio
+import datetime
+from typing import Iterator
 
+from sqlalchemy import and_, func, or_, update
 from sqlmodel import Session, select
 
 import coupon
 import base_model as bm
 import db
+import feed
+import metrics
+import queue_engine
 
 import exception as xc
+import serialize
 from config import settings
 
+WAITING = db.Qitem.completed_at.is_(None)  # pylint: disable=no-member
+QUEUE_ORDER = (db.Qitem.vip.desc(), db.Qitem.id)  # see index ix_qitem_waiting_order
+QUEUE_FULL_MESSAGE = "Sorry, the waiting room is full. Please try again later"
+REJECTION_REASONS = {  # of metrics.rejections, by message
+    QUEUE_FULL_MESSAGE: "queue_full",
+    coupon.GLOBAL_LIMIT_MESSAGE: "exhausted",
+    coupon.USER_LIMIT_MESSAGE: "user_limit",
+}
+QITEM_KEYS = (
+    "id",
+    "created_at",
+    "vip",
+    "user_name",
+    "order_id",
+    "coupon_name",
+    "final_price",
+)
+LISTING_KEYS = ("queue_position", *QITEM_KEYS)  # of GET /queue
+LISTING_COLUMNS = [getattr(db.Qitem, k) for k in QITEM_KEYS]
+
 
 def create(qitem: bm.CreateQitem) -> dict:
-    """implement POST /qitem"""
-    # to make sure user exists in user table
-    db.get_one_record("user", "user_name", qitem.user_name)
-    record = dict(
+    """implement POST /qitem, in one transaction"""
+    try:
+        ret = _create(qitem)
+    except xc.CouponUserError as err:
+        _count_rejection(err)
+        raise
+    if qitem.coupon_name is not None:
+        metrics.redemptions.inc(qitem.coupon_name)
+    return ret
+
+
+def _create(qitem: bm.CreateQitem) -> dict:
+    """create() without metrics"""
+    record = _new_record(qitem)
+
+    with Session(db.engine) as session:
+        # to make sure user exists in user table
+        db.get_one_record("user", "user_name", qitem.user_name, session=session)
+
+        coupon.apply(qitem, record, session)
+
+        _check_queue_len = record.pop("_check_queue_len")
+        if _check_queue_len:
+            db.lock_queue(session)  # until commit, so nobody else squeezes in
+        queue_len = get_len(session)
+        if _check_queue_len and queue_len >= settings.max_queue_len:
+            raise xc.CouponUserError(QUEUE_FULL_MESSAGE)
+        insert = db.Qitem(**record)
+        session.add(insert)
+        session.flush()  # to get insert.id
+        ret = dict(
+            final_price=insert.final_price,
+            queue_position=_count_ahead(session, insert.vip, insert.id),
+            id=insert.id,
+            queue_len=queue_len,
+        )
+        item = _qitem_dict(insert)
+        feed.commit(session, added=[item])
+    if queue_engine.enabled():
+        queue_engine.queue.add(item)
+    return ret
+
+
+def create_batch(qitems: list[bm.CreateQitem]) -> dict:
+    """
+    implement POST /queue/batch, in one transaction.
+    Items are handled in input order, as if posted one by one, but with one lookup per user and coupon,
+    one SELECT per redemption counter table, one waiting room check, one multi-row INSERT,
+    and position COUNTs per VIP level. Result of each item is as of POST /queue or an error message.
+    """
+    if len(qitems) > settings.max_queue_batch:
+        raise xc.CouponUserError(f"Must be at most {settings.max_queue_batch} items")
+    records = [_new_record(qitem) for qitem in qitems]
+    errors: list[Exception | None] = []
+    with Session(db.engine) as session:
+        for qitem in qitems:
+            try:
+                # to make sure user exists in user table
+                db.get_one_record("user", "user_name", qitem.user_name)
+                errors.append(None)
+            except xc.CouponUserError as err:
+                errors.append(err)
+        coupon_dicts, coupon_errors = coupon.apply_batch(qitems, records, session)
+        errors = [err or coupon_err for err, coupon_err in zip(errors, coupon_errors)]
+        uses = coupon.BatchUses(
+            session,
+            [
+                (coupon_dict, qitem.user_name)
+                for qitem, coupon_dict, err in zip(qitems, coupon_dicts, errors)
+                if coupon_dict is not None and err is None
+            ],
+        )
+        db.lock_queue(session)  # until commit, so nobody else squeezes in
+        queue_len = get_len(session)
+        for i, (qitem, record) in enumerate(zip(qitems, records)):
+            if errors[i] is not None:
+                continue
+            try:
+                counters = uses.check(coupon_dicts[i], qitem.user_name)
+                if record["_check_queue_len"] and queue_len >= settings.max_queue_len:
+                    raise xc.CouponUserError(QUEUE_FULL_MESSAGE)
+            except xc.CouponUserError as err:
+                errors[i] = err
+                continue
+            uses.use(counters)
+            queue_len += 1
+
+        inserts = [
+            db.Qitem(**_record_without_flags(record)).dict(exclude={"id"})
+            for record, err in zip(records, errors)
+            if err is None
+        ]
+        for insert, qitem_id in zip(
+            inserts, db.insert_many(session, db.Qitem, inserts)
+        ):
+            insert["id"] = qitem_id
+        positions = _batch_positions(session, inserts)
+        items = [{k: insert[k] for k in QITEM_KEYS} for insert in inserts]
+        feed.commit(session, added=items)
+    if queue_engine.enabled():
+        for item in items:
+            queue_engine.queue.add(item)
+
+    inserted = iter(inserts)
+    results = []
+    for err in errors:
+        if err is not None:
+            _count_rejection(err)
+            results.append({"message": " ".join(err.args)})
+            continue
+        insert = next(inserted)
+        if insert["coupon_name"] is not None:
+            metrics.redemptions.inc(insert["coupon_name"])
+        results.append(
+            dict(
+                final_price=insert["final_price"],
+                queue_position=positions[insert["id"]],
+                id=insert["id"],
+            )
+        )
+    return {"results": results, "queue_len": queue_len}
+
+
+def _new_record(qitem: bm.CreateQitem) -> dict:
+    """qitem record to be modified by coupon, then inserted"""
+    return dict(
         user_name=qitem.user_name,
         order_id=qitem.order_id,
         coupon_name=qitem.coupon_name,
@@ -22,87 +172,391 @@ def create(qitem: bm.CreateQitem) -> dict:
         _check_queue_len=True,
     )
 
-    ret = coupon.apply(qitem, record)
 
-    queue_len = get_len()
-    _check_queue_len = record.pop("_check_queue_len")
-    if _check_queue_len and queue_len >= settings.max_queue_len:
-        raise xc.CouponUserError(
-            "Sorry, the waiting room is full. Please try again later"
+def _record_without_flags(record: dict) -> dict:
+    """qitem record without flags set by coupon params"""
+    return {k: v for k, v in record.items() if not k.startswith("_")}
+
+
+def _batch_positions(session: Session, inserts: list[dict]) -> dict[int, int]:
+    """
+    Queue positions of just inserted items by id: per VIP level, one COUNT of the items ahead of
+    the first one, the rest follow it (ids of one INSERT are consecutive in the queue)
+    """
+    positions = {}
+    for vip in {insert["vip"] for insert in inserts}:
+        qitem_ids = sorted(insert["id"] for insert in inserts if insert["vip"] == vip)
+        ahead = _count_ahead(session, vip, qitem_ids[0])
+        positions.update({qitem_id: ahead + i for i, qitem_id in enumerate(qitem_ids)})
+    return positions
+
+
+def get_all(
+    after: str | None = None,
+    limit: int | None = None,
+    fresh: bool = False,
+    columnar: bool = False,
+) -> dict:
+    """
+    Implement GET /queue, a page of limit items after cursor after if limit is given,
+    items as dicts, or as one list per key if columnar.
+    Whole queue may come from memory, pages come from DB: a read replica, unless fresh.
+    """
+    if after is None and limit is None and queue_engine.enabled():
+        rows = [
+            (queue_position, *(item[k] for k in QITEM_KEYS))
+            for queue_position, item in enumerate(queue_engine.queue.items())
+        ]
+    else:
+        rows = list(_stream_rows(_parse_cursor(after), limit, fresh))
+    queue_items = (
+        serialize.columns(LISTING_KEYS, rows)
+        if columnar
+        else [dict(zip(LISTING_KEYS, row)) for row in rows]
+    )
+    if limit is None:
+        return {"queue_items": queue_items}
+    next_after = (
+        _cursor(dict(zip(LISTING_KEYS, rows[-1]))) if len(rows) == limit else None
+    )
+    return {"queue_items": queue_items, "next": next_after}
+
+
+def stream_all(
+    after: str | None = None, limit: int | None = None, fresh: bool = False
+) -> Iterator[dict]:
+    """Implement GET /queue?format=ndjson, in queue order, from a server side cursor"""
+    # parse now, not when streaming has started already
+    rows = _stream_rows(_parse_cursor(after), limit, fresh)
+    return (dict(zip(LISTING_KEYS, row)) for row in rows)
+
+
+def _stream_rows(
+    after: tuple[int, int] | None, limit: int | None, fresh: bool
+) -> Iterator[tuple]:
+    """Rows of LISTING_KEYS in queue order, by selecting just those columns, no ORM objects"""
+    statement = select(*LISTING_COLUMNS).where(WAITING).order_by(*QUEUE_ORDER)
+    if limit is not None:
+        statement = statement.limit(limit)
+    with Session(db.reader(fresh)) as session:
+        queue_position = 0
+        if after is not None:  # keyset pagination
+            vip, qitem_id = after
+            statement = statement.where(
+                or_(
+                    db.Qitem.vip < vip,
+                    and_(db.Qitem.vip == vip, db.Qitem.id > qitem_id),
+                )
+            )
+            queue_position = _count_ahead(session, vip, qitem_id + 1)
+        results = session.execute(
+            statement.execution_options(
+                stream_results=True, yield_per=settings.stream_batch_size
+            )
         )
-    insert = db.Qitem(**record)
+        for row in results:
+            yield (queue_position, *row)
+            queue_position += 1
+
+
+def _cursor(queue_item: dict) -> str:
+    """Keyset pagination cursor of GET /queue pointing after queue_item"""
+    return f"{queue_item['vip']}:{queue_item['id']}"
+
+
+def _parse_cursor(after: str | None) -> tuple[int, int] | None:
+    """vip and id of cursor, None if no cursor"""
+    if after is None:
+        return None
+    try:
+        vip, qitem_id = after.split(":")
+        return int(vip), int(qitem_id)
+    except ValueError as err:
+        raise xc.CouponUserError(f"Invalid cursor {after}") from err
+
+
+def _qitem_dict(record: db.Qitem) -> dict:
+    """Queue item as returned by API, without queue_position"""
+    return {k: getattr(record, k) for k in QITEM_KEYS}
+
+
+def shift(count: int) -> dict:
+    """implement PUT /queue/shift/{count}"""
+    return {
+        "shifted": len(consume(count)["queue_items"]),
+        "queue_len": get_len(fresh=True),
+    }
+
+
+def consume(count: int) -> dict:
+    """
+    implement POST /queue/consume/{count}: mark the first count waiting items completed, return them in queue order.
+    Items leased by a worker are skipped. Completed items stay, as order history, until archived.
+    """
+    completed_at = datetime.datetime.utcnow()
     with Session(db.engine) as session:
-        session.add(insert)
+        queue_items = _update_head(session, count, completed_at=completed_at)
+        _count_completed(session, queue_items)
+        feed.commit(session, removed=queue_items)
+    if queue_engine.enabled():
+        queue_engine.queue.remove(item["id"] for item in queue_items)
+    return {"queue_items": queue_items, "queue_len": get_len(fresh=True)}
+
+
+def claim(lease: bm.ClaimQitems) -> dict:
+    """
+    implement POST /queue/claim: lease the first count waiting items not leased to anyone to a worker,
+    who is to extend the lease while working on them, then complete them. Expired leases can be claimed again.
+    """
+    if lease.count < 1:
+        raise xc.CouponUserError("Must be count >= 1")
+    lease_expires_at = _lease_expires_at()
+    with Session(db.engine) as session:
+        queue_items = _update_head(
+            session,
+            lease.count,
+            claimed_by=lease.worker,
+            lease_expires_at=lease_expires_at,
+        )
         session.commit()
-        session.refresh(insert)  # to get insert.id
-        statement = (
-            select(db.Qitem)
-            .where(db.Qitem.completed_at is not None)
-            .where(db.Qitem.vip >= insert.vip)
+    return {"queue_items": queue_items}
+
+
+def extend_lease(qitem_id: int, lease: bm.Lease) -> dict:
+    """implement PUT /queue/{qitem_id}/lease, heartbeat of the worker having claimed it"""
+    lease_expires_at = _lease_expires_at()
+    with Session(db.engine) as session:
+        _update_leased(
+            session, qitem_id, lease.worker, lease_expires_at=lease_expires_at
         )
-        results = session.exec(statement)
-        queue_position = len(list(results))
-    return dict(
-        final_price=insert.final_price,
-        queue_position=queue_position,
-        id=insert.id,
-        queue_len=queue_len,
-    )
+        session.commit()
+    return {"id": qitem_id, "lease_expires_at": lease_expires_at}
 
 
-def get_all() -> dict:
-    """implement GET /queue"""
-    queue_items = []
+def complete(qitem_id: int, lease: bm.Lease) -> dict:
+    """implement POST /queue/{qitem_id}/complete, by the worker having claimed it"""
+    completed_at = datetime.datetime.utcnow()
     with Session(db.engine) as session:
-        # -1 order by desc
+        _update_leased(session, qitem_id, lease.worker, completed_at=completed_at)
+        item = _qitem_dict(session.get(db.Qitem, qitem_id))
+        _count_completed(session, [item])
+        feed.commit(session, removed=[item])
+    if queue_engine.enabled():
+        queue_engine.queue.remove([qitem_id])
+    return {"id": qitem_id, "completed_at": completed_at}
+
+
+def _lease_expires_at() -> datetime.datetime:
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.lease_secs)
+
+
+def _update_leased(session: Session, qitem_id: int, worker: str, **values) -> None:
+    """Update a waiting item leased to worker, even if the lease expired but nobody claimed it since"""
+    statement = (
+        update(db.Qitem)
+        .where(db.Qitem.id == qitem_id, db.Qitem.claimed_by == worker)
+        .where(WAITING)
+        .values(**values)
+    )
+    if not session.execute(statement).rowcount:
+        raise xc.Coupon404(f"No such id waiting in queue claimed by {worker}")
+
+
+def _count_completed(session: Session, queue_items: list[dict]) -> None:
+    """
+    Add just completed queue items to the statistics of their users.
+    A missing statistics record is backfilled from all completed items of the user, these and archived ones included.
+    """
+    per_user: dict[str, list[int]] = {}
+    for item in queue_items:
+        stat = per_user.setdefault(item["user_name"], [0, 0])
+        stat[0] += 1
+        stat[1] += item["final_price"]
+    for user_name, (completed_orders, spend) in per_user.items():
         statement = (
-            select(db.Qitem)
-            .where(db.Qitem.completed_at is not None)
-            .order_by(-1 * db.Qitem.vip, db.Qitem.id)
+            update(db.UserStat)
+            .where(db.UserStat.user_name == user_name)
+            .values(
+                completed_orders=db.UserStat.completed_orders + completed_orders,
+                lifetime_spend=db.UserStat.lifetime_spend + spend,
+            )
+            .execution_options(synchronize_session=False)
         )
-        results = session.exec(statement)
-        queue_position = 0
-        for record in results:
-            queue_items.append(
+        if session.execute(statement).rowcount:
+            continue
+        history = db.qitem_history("id", "user_name", "final_price", "completed_at")
+        backfill = session.exec(
+            select(
+                func.count(),
+                func.coalesce(func.sum(history.c.final_price), 0),
+            )
+            .where(history.c.user_name == user_name)
+            .where(history.c.completed_at.is_not(None))
+            .where(history.c.id.not_in([item["id"] for item in queue_items]))
+        ).one()
+        # concurrent completions of the same user: one of them inserts it, all of them retry the UPDATE
+        db.insert_ignore(
+            session,
+            db.UserStat,
+            [
                 {
-                    "queue_position": queue_position,
-                    **{
-                        k: getattr(record, k)
-                        for k in (
-                            "id",
-                            "created_at",
-                            "vip",
-                            "user_name",
-                            "order_id",
-                            "coupon_name",
-                            "final_price",
-                        )
-                    },
+                    "user_name": user_name,
+                    "completed_orders": backfill[0],
+                    "lifetime_spend": backfill[1],
                 }
-            )
-            queue_position += 1
-        return {"queue_items": queue_items}
+            ],
+        )
+        session.execute(statement)
 
 
-def shift(count: int) -> dict:
-    """implement PUT /queue/shift/{count}"""
-    with Session(db.engine) as session:
+def _update_head(session: Session, count: int, **values) -> list[dict]:
+    """
+    Update the first count waiting, not leased items with values, return them in queue order.
+    Postgres: one UPDATE ... WHERE id IN (SELECT ... LIMIT count FOR UPDATE SKIP LOCKED) RETURNING,
+    so concurrent consumers get different items, none of them is processed twice.
+    The UPDATE checks them to be claimable again, as of its own time, so an item completed or claimed
+    meanwhile is not updated (nor returned) even if the select saw it before.
+    """
+    claimable = [
+        WAITING,
+        or_(
+            db.Qitem.claimed_by.is_(None),  # pylint: disable=no-member
+            db.Qitem.lease_expires_at < datetime.datetime.utcnow(),
+        ),
+    ]
+    head = select(db.Qitem.id).where(*claimable).order_by(*QUEUE_ORDER).limit(count)
+    columns = [getattr(db.Qitem, k) for k in QITEM_KEYS]
+    if session.get_bind().dialect.name == "postgresql":
         statement = (
-            select(db.Qitem)
-            .where(db.Qitem.completed_at is not None)
-            .order_by(-1 * db.Qitem.vip, db.Qitem.id)
-            .limit(count)
+            update(db.Qitem)
+            .where(db.Qitem.id.in_(head.with_for_update(skip_locked=True)))
+            .where(*claimable)
+            .values(**values)
+            .returning(*columns)
         )
-        results = session.exec(statement)
-        db.delete_results(session, results)
-        shifted = len(list(results))
-        session.commit()
-        return {"shifted": shifted, "queue_len": get_len()}
+        rows = session.execute(statement).all()
+    else:  # no RETURNING, see db.insert_many
+        db.lock_queue(session)
+        rows = session.execute(select(*columns).where(db.Qitem.id.in_(head))).all()
+        session.execute(
+            update(db.Qitem)
+            .where(db.Qitem.id.in_([row.id for row in rows]))
+            .where(*claimable)
+            .values(**values)
+        )
+    return sorted(
+        ({**row._asdict(), **values} for row in rows),
+        key=lambda item: (-item["vip"], item["id"]),
+    )
 
 
-def get_len() -> int:
-    """Return the number of not completed items in the queue"""
+def get_len(session: Session = None, fresh: bool = False) -> int:
+    """Return the number of not completed items in the queue
+    Without session, it may come from memory or a read replica (unless fresh);
+    with session, it comes from that transaction
+    """
+    if session is None:
+        if queue_engine.enabled():
+            return len(queue_engine.queue)
+        with Session(db.reader(fresh)) as session:
+            return get_len(session)
+    return session.exec(select(func.count(db.Qitem.id)).where(WAITING)).one()
+
+
+def get_len_by_vip(session: Session = None) -> dict[int, int]:
+    """Return the number of not completed items in the queue per VIP level, from DB"""
+    if session is None:
+        with Session(db.engine) as session:
+            return get_len_by_vip(session)
+    return dict(
+        session.exec(
+            select(db.Qitem.vip, func.count(db.Qitem.id))
+            .where(WAITING)
+            .group_by(db.Qitem.vip)
+        ).all()
+    )
+
+
+def _count_rejection(err: xc.CouponUserError) -> None:
+    """Count a rejected queue item in metrics, by reason"""
+    reason = REJECTION_REASONS.get(" ".join(err.args))
+    if reason is None:
+        reason = "not_found" if isinstance(err, xc.Coupon404) else "other"
+    metrics.rejections.inc(reason)
+
+
+def get_position(qitem_id: int) -> dict:
+    """implement GET /queue/{qitem_id}/position"""
+    if queue_engine.enabled():
+        queue_position = queue_engine.queue.position(qitem_id)
+        if queue_position is None:
+            raise xc.Coupon404("No such id waiting in queue")
+        return {"id": qitem_id, "queue_position": queue_position}
     with Session(db.engine) as session:
-        statement = select(db.Qitem).where(db.Qitem.completed_at is not None)
-        results = session.exec(statement)
-        return len(list(results))  # func.count .one()
+        qitem = session.exec(
+            select(db.Qitem).where(db.Qitem.id == qitem_id).where(WAITING)
+        ).first() or xc.raiser(xc.Coupon404("No such id waiting in queue"))
+        return {
+            "id": qitem_id,
+            "queue_position": _count_ahead(session, qitem.vip, qitem.id),
+        }
+
+
+def subscribe(
+    qitem_id: int, loop: asyncio.AbstractEventLoop, with_len: bool = False
+) -> feed.Subscription:
+    """Implement GET /queue/{qitem_id}/events: subscribe to position (and queue length) updates of a waiting item"""
+
+    def snapshot(ambiguous) -> tuple[tuple[int, int, int | None], dict[int, bool]]:
+        """See feed.Subscription"""
+        with Session(db.engine) as session:
+            if session.get_bind().dialect.name == "postgresql":
+                # all reads from the snapshot of the first one; SQLite reads each from the latest commit,
+                # so it may drift until resynced
+                session.connection(
+                    execution_options={"isolation_level": "REPEATABLE READ"}
+                )
+            qitem = session.exec(
+                select(db.Qitem).where(db.Qitem.id == qitem_id).where(WAITING)
+            ).first() or xc.raiser(xc.Coupon404("No such id waiting in queue"))
+            queue_position = _count_ahead(session, qitem.vip, qitem.id)
+            queue_len = get_len(session) if with_len else None
+            qitem_ids = ambiguous()
+            history = db.qitem_history("id", "completed_at")
+            seen = dict(
+                session.exec(
+                    select(history.c.id, history.c.completed_at.is_not(None)).where(
+                        history.c.id.in_(qitem_ids)
+                    )
+                ).all()
+                if qitem_ids
+                else []
+            )
+            return (qitem.vip, queue_position, queue_len), seen
+
+    return feed.subscribe(qitem_id, loop, snapshot)
+
+
+def _count_ahead(session: Session, vip: int, qitem_id: int) -> int:
+    """0-based queue position of item (vip, qitem_id) as in GET /queue, by one range COUNT on the index"""
+    return session.exec(
+        select(func.count(db.Qitem.id))
+        .where(WAITING)
+        .where(
+            or_(
+                db.Qitem.vip > vip,
+                and_(db.Qitem.vip == vip, db.Qitem.id < qitem_id),
+            )
+        )
+    ).one()
+
+
+def load_engine() -> None:
+    """Load the in-process queue engine from DB, if enabled"""
+    if not queue_engine.enabled():
+        return
+    with Session(db.engine) as session:
+        statement = select(db.Qitem).where(WAITING).order_by(*QUEUE_ORDER)
+        queue_engine.queue.load(
+            _qitem_dict(record) for record in session.exec(statement)
+        )
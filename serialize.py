@@ -0,0 +1,33 @@
+"""Serialization of responses for project Coupon: JSON bodies, NDJSON lines, columnar listings"""
+import json
+
+try:
+    import orjson  # optional, several times faster
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
+
+
+def json_body(content: dict) -> bytes:
+    """JSON response body, datetimes as ISO 8601 like FastAPI does, by orjson if installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content,
+        default=lambda obj: obj.isoformat(),
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+def ndjson_line(record: dict) -> bytes:
+    """One line of newline delimited JSON, datetimes as ISO 8601 like FastAPI does"""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return json_body(record) + b"\n"
+
+
+def columns(keys: tuple[str, ...], rows: list[tuple]) -> dict[str, list]:
+    """Columnar form of rows: one list of values per key"""
+    if not rows:
+        return {key: [] for key in keys}
+    return dict(zip(keys, map(list, zip(*rows))))
@@ -1,17 +1,29 @@
 """Unit test for project Coupon"""
+import asyncio
+import json
 import os
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 from fastapi.testclient import TestClient
 
 test_dir = os.path.join(os.path.dirname(__file__))
 sys.path.append(os.path.join(test_dir, ".."))
 
+import coupon  # pylint: disable=wrong-import-position
 import db  # pylint: disable=wrong-import-position  # why should it go to top? Too nice coupon_name?
+import exception  # pylint: disable=wrong-import-position
+import feed  # pylint: disable=wrong-import-position
+import name_pool  # pylint: disable=wrong-import-position
+import queue_item  # pylint: disable=wrong-import-position
 from main import app  # pylint: disable=import-error,wrong-import-position
 from config import settings  # pylint: disable=wrong-import-position  # why should it go to top? Too nice coupon_name?
 
-client = TestClient(app)
+client = TestClient(app)  # not as context manager, so no startup handlers
+db.init()  # e.g. DB_URL=sqlite:// for an in-memory database
 
 # For json's sake:
 null = None # pylint: disable=invalid-name
@@ -28,6 +40,18 @@ class TestApi(unittest.TestCase):
     def tearDown(self):
         pass # don't do anything so we can examine records inserted by last test afterwards
 
+    def assert_query_budget(self, max_statements, method, url, **kwargs):
+        """Request url, assert it's OK by at most max_statements SQL statements, return response"""
+        settings.sql_profile = True
+        try:
+            response = client.request(method, url, **kwargs)
+        finally:
+            settings.sql_profile = False
+        self.assertEqual(response.status_code, 200, response.text)
+        statements = int(response.headers["x-sql-statements"])
+        self.assertLessEqual(statements, max_statements, f"{method} {url} issued {statements} SQL statements")
+        return response
+
     def test_basic_oks(self):
         """Test basic OK's"""
         response = client.get("/queue")
@@ -163,6 +187,81 @@ class TestApi(unittest.TestCase):
         self.assertIn("final_price", response.json())
 
 
+    def test_max_use_count_per_user_counter(self):
+        """Test max_use_count_per_user above 1 is counted per user"""
+
+        response = client.post("/coupon", json={
+            "params": {"pricing": {"percent": -10}},
+            "coupon_name": "-10% pub 2 3",
+            "user_name": null,
+            "max_use_count_per_user": 2,
+            "max_use_count_global": 3
+        },)
+        self.assertEqual(response.json(), {
+              "coupon_name": "-10% pub 2 3"
+        })
+
+        # 2 adds succeed for same user, 3rd fails
+        for _ in range(2):
+            response = client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": "-10% pub 2 3",
+                "list_price": 20000,
+                "order_id": "RDR42/" + str(_)
+            },)
+            self.assertEqual(response.json()["final_price"], 18000)
+        response = client.post("/queue", json={
+            "user_name": "john_smith",
+            "coupon_name": "-10% pub 2 3",
+            "list_price": 20000,
+            "order_id": "RDR42/2"
+        },)
+        self.assertEqual(response.json(), {
+            "message": "You cannot use this coupon more"
+        })
+
+        # Failed add is not counted: one more global use is left for another user
+        response = client.post("/queue", json={
+            "user_name": "maria_de_silva",
+            "coupon_name": "-10% pub 2 3",
+            "list_price": 20000,
+            "order_id": "RDR43/0"
+        },)
+        self.assertIn("final_price", response.json())
+        response = client.post("/queue", json={
+            "user_name": "maria_de_silva",
+            "coupon_name": "-10% pub 2 3",
+            "list_price": 20000,
+            "order_id": "RDR43/1"
+        },)
+        self.assertEqual(response.json(), {
+            "message": "Sorry, the framework for this coupon has been exhausted by customers"
+        })
+
+    def test_counter_created_meanwhile(self):
+        """Test first redemptions racing to create a counter: the loser uses the winner's one, no conflict"""
+        client.post("/coupon", json={
+            "params": {},
+            "coupon_name": "Launch",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": 2
+        },)
+        insert_ignore = db.insert_ignore
+
+        def concurrent_first(session, cls, rows):
+            insert_ignore(session, cls, [{**rows[0], "use_count": 1}])  # committed by the winner meanwhile
+            insert_ignore(session, cls, rows)
+
+        order = {"user_name": "john_smith", "coupon_name": "Launch", "list_price": 20000, "order_id": "L1"}
+        with unittest.mock.patch.object(db, "insert_ignore", concurrent_first):
+            response = client.post("/queue", json=order)
+        self.assertIn("final_price", response.json())
+        with db.Session(db.engine) as session:
+            self.assertEqual(session.get(db.CouponUse, "Launch").use_count, 2)
+        response = client.post("/queue", json=order)
+        self.assertEqual(response.json()["message"], "Sorry, the framework for this coupon has been exhausted by customers")
+
     def test_max_use_count_global(self):
         """Test max_use_count_global"""
 
@@ -305,6 +404,726 @@ class TestApi(unittest.TestCase):
         order_ids = [q["order_id"] for q in  response.json()["queue_items"]]
         self.assertEqual(order_ids, ["1st VIP", "2nd VIP", "1st non-VIP", "1st non-VIP"])
 
+    def test_queue_position(self):
+        """Test queue position of an item, VIPs are ahead"""
+
+        response = client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "VIP pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        ids = []
+        for coupon_name in [null, null, "VIP pub ~ ~"]:
+            response = client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": coupon_name,
+                "list_price": 20000,
+                "order_id": "RDR42"
+            },)
+            ids.append(response.json()["id"])
+        self.assertEqual(response.json()["queue_position"], 0)
+
+        positions = [client.get(f"/queue/{id_}/position").json()["queue_position"] for id_ in ids]
+        self.assertEqual(positions, [1, 2, 0])
+        listed = {q["id"]: q["queue_position"] for q in client.get("/queue").json()["queue_items"]}
+        self.assertEqual(positions, [listed[id_] for id_ in ids])
+
+        client.put("/queue/shift/1")
+        response = client.get(f"/queue/{ids[2]}/position")
+        self.assertEqual(response.status_code, 404)
+        response = client.get(f"/queue/{ids[1]}/position")
+        self.assertEqual(response.json(), {"id": ids[1], "queue_position": 1})
+
+    def test_queue_engine(self):
+        """Test in-memory queue engine gives the same answers as DB"""
+
+        response = client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "VIP pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        ids = []
+        for coupon_name in [null, "VIP pub ~ ~", null, "VIP pub ~ ~"]:
+            response = client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": coupon_name,
+                "list_price": 20000,
+                "order_id": "RDR42"
+            },)
+            ids.append(response.json()["id"])
+            if len(ids) == 2:  # load half-way, rest is written through
+                settings.queue_engine = True
+                self.addCleanup(setattr, settings, "queue_engine", False)
+                queue_item.load_engine()
+
+        for shift_count in [0, 1]:
+            if shift_count:
+                client.put(f"/queue/shift/{shift_count}")
+            for path in ["/queue", "/queue/len"] + [f"/queue/{id_}/position" for id_ in ids]:
+                settings.queue_engine = False
+                expected = client.get(path)
+                settings.queue_engine = True
+                response = client.get(path)
+                self.assertEqual(response.status_code, expected.status_code, path)
+                self.assertEqual(response.json(), expected.json(), path)
+
+        # written through out of commit order: consumed before its create has added it
+        queue_engine = queue_item.queue_engine.QueueEngine()
+        queue_engine.remove([42])
+        queue_engine.add({"id": 42, "vip": 0})
+        self.assertEqual((len(queue_engine), queue_engine.position(42)), (0, None))
+
+    def test_pool_status(self):
+        """Test connection pool statistics"""
+        if not isinstance(db.engine.pool, db.MeteredQueuePool):
+            self.skipTest("in-memory SQLite has a single connection, no pool")
+        response = client.get("/db/pool")
+        self.assertEqual(response.status_code, 200)
+        status = response.json()
+        self.assertEqual(status["pool_size"], settings.db_pool_size)
+        self.assertGreater(status["checkouts"], 0)
+        self.assertEqual(status["waiting"], 0)
+
+    def test_cache(self):
+        """Test coupon cache incl. negative caching and invalidation on create"""
+        response = client.get("/coupon/-5% pub ~ ~")
+        self.assertEqual(response.status_code, 404)
+        misses = client.get("/cache").json()["coupons"]["misses"]
+        response = client.get("/coupon/-5% pub ~ ~")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(client.get("/cache").json()["coupons"]["misses"], misses)
+
+        response = client.post("/coupon", json={
+            "params": {"pricing": {"percent": -5}},
+            "coupon_name": "-5% pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        response = client.get("/coupon/-5% pub ~ ~")
+        self.assertEqual(response.json()["params"], {"pricing": {"percent": -5}})
+        stats = client.get("/cache").json()["coupons"]
+        for _ in range(2):
+            response = client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": "-5% pub ~ ~",
+                "list_price": 20000,
+                "order_id": "RDR42"
+            },)
+            self.assertEqual(response.json()["final_price"], 19000)
+        self.assertEqual(client.get("/cache").json()["coupons"]["misses"], stats["misses"])
+        self.assertEqual(client.get("/cache").json()["coupons"]["hits"], stats["hits"] + 2)
+
+    def test_invalid_params(self):
+        """Test coupon params are validated at create"""
+        for params, message in [
+            ({"pricing": {"percent": 15}}, "Must be 0 > percent >= -100 in {'pricing': {'percent': 15}}"),
+            ({"pricing": {"percent": -15, "amount": -2000}},
+             "must not use amount and percent together in {'pricing': {'percent': -15, 'amount': -2000}}"),
+            ({"pricing": {"check_percent": -15}}, "Invalid param pricing.check_percent in {'pricing': {'check_percent': -15}}"),
+            ({"pricing": {"select": 1}}, "Invalid param pricing.select in {'pricing': {'select': 1}}"),
+            ({"nope": {"vip": 1}}, "Invalid param nope in {'nope': {'vip': 1}}"),
+            ({"pricing": {"percent": "x"}}, "Must be 0 > percent >= -100 in {'pricing': {'percent': 'x'}}"),
+            ({"pricing": {"percent": null}}, "Must be 0 > percent >= -100 in {'pricing': {'percent': None}}"),
+            ({"pricing": {"amount": "x"}}, "Must be value < 0 in {'pricing': {'amount': 'x'}}"),
+            ({"queuing": {"vip": "high"}}, "Must be vip an integer >= 0 in {'queuing': {'vip': 'high'}}"),
+            ({"queuing": {"reopen": "maybe"}}, "Must be reopen true or false in {'queuing': {'reopen': 'maybe'}}"),
+        ]:
+            response = client.post("/coupon", json={
+                "params": params,
+                "coupon_name": "Invalid",
+                "user_name": null,
+                "max_use_count_per_user": null,
+                "max_use_count_global": null
+            },)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {"message": message})
+        response = client.get("/coupon/Invalid")
+        self.assertEqual(response.status_code, 404)
+
+    def test_pagination(self):
+        """Test keyset pagination and NDJSON streaming of GET /coupon and GET /queue"""
+        for coupon_name, params in [("B VIP", {"queuing": {"vip": 1}}), ("A -5%", {"pricing": {"percent": -5}}),
+                                    ("C -1%", {"pricing": {"percent": -1}})]:
+            client.post("/coupon", json={
+                "params": params,
+                "coupon_name": coupon_name,
+                "user_name": null,
+                "max_use_count_per_user": null,
+                "max_use_count_global": null
+            },)
+            client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": coupon_name,
+                "list_price": 20000,
+                "order_id": coupon_name
+            },)
+
+        for path, key, cursor_key in [("/coupon", "coupons", "coupon_name"), ("/queue", "queue_items", "order_id")]:
+            whole = client.get(path).json()[key]
+            self.assertEqual(len(whole), 3)
+            pages, after = [], None
+            while True:
+                response = client.get(path, params={"limit": 2, **({"after": after} if after else {})}).json()
+                pages += response[key]
+                after = response["next"]
+                if after is None:
+                    break
+            self.assertEqual(pages, whole)
+            response = client.get(path, params={"format": "ndjson"})
+            self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+            self.assertEqual([json.loads(line) for line in response.text.splitlines()], whole)
+            self.assertEqual([item[cursor_key] for item in whole],
+                             ["A -5%", "B VIP", "C -1%"] if key == "coupons" else ["B VIP", "A -5%", "C -1%"])
+
+        response = client.get("/queue", params={"limit": 2, "after": "1:2:3"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_coupon_batch(self):
+        """Test generating coupons in bulk"""
+        response = client.post("/coupon/batch", json={
+            "params": {"pricing": {"amount": -2000}},
+            "count": 1500,
+            "user_name": "maria_de_silva",
+            "max_use_count_per_user": 1,
+            "max_use_count_global": 1
+        },)
+        coupon_names = response.json()["coupon_names"]
+        self.assertEqual(len(set(coupon_names)), 1500)
+        self.assertTrue(all(len(name) == settings.coupon_name_len for name in coupon_names))
+        response = client.get(f"/coupon/{coupon_names[-1]}")
+        self.assertEqual(response.json(), {
+            "coupon_name": coupon_names[-1],
+            "params": {"pricing": {"amount": -2000}},
+            "user_name": "maria_de_silva",
+            "max_use_count_per_user": 1,
+            "max_use_count_global": 1
+        })
+
+        response = client.post("/coupon/batch", json={"params": {}, "count": 0},)
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/coupon/batch", json={"params": {"pricing": {"amount": 1}}, "count": 1},)
+        self.assertEqual(response.json(), {"message": "Must be value < 0 in {'pricing': {'amount': 1}}"})
+
+        self.addCleanup(setattr, name_pool.pool, "name_len", name_pool.pool.name_len)
+        name_pool.pool.name_len = 2  # 1296 names
+        response = client.post("/coupon/batch", json={"params": {}, "count": 1300},)
+        self.assertEqual(response.status_code, 400)
+
+    def test_name_pool(self):
+        """Test generated coupon names come from the pool, namespace grows when crowded"""
+        name_pool.pool.refill()
+        pool_size = client.get("/coupon_namespace").json()["pool_size"]
+        self.assertGreater(pool_size, 0)
+        response = client.post("/coupon", json={"params": {}},)
+        self.assertEqual(len(response.json()["coupon_name"]), settings.coupon_name_len)
+        self.assertLess(client.get("/coupon_namespace").json()["pool_size"], pool_size)
+
+        self.addCleanup(setattr, name_pool.pool, "name_len", name_pool.pool.name_len)
+        name_pool.pool.name_len = 1
+        client.post("/coupon/batch", json={"params": {}, "count": 18},)
+        self.assertEqual(client.get("/coupon_namespace").json()["name_len"], 1)  # as of last refill
+        name_pool.pool.refill()
+        status = client.get("/coupon_namespace").json()
+        self.assertEqual(status["name_len"], 2)
+        self.assertEqual(status["capacity"], len(settings.coupon_alphabet) ** 2)
+
+    def test_queue_batch(self):
+        """Test placing many orders at once"""
+        client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "VIP pub ~ 1",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": 1
+        },)
+        client.post("/coupon", json={
+            "params": {"pricing": {"percent": -15}, "queuing": {"reopen": True}},
+            "coupon_name": "-15%+Reopen pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": 2,
+            "max_use_count_global": null
+        },)
+        self.addCleanup(setattr, settings, "max_queue_len", settings.max_queue_len)
+        settings.max_queue_len = 3
+
+        def order(user_name, coupon_name, order_id):
+            return {"user_name": user_name, "coupon_name": coupon_name, "list_price": 20000, "order_id": order_id}
+
+        response = client.post("/queue/batch", json=[
+            order("john_smith", null, "plain"),
+            order("Nessuno", null, "no such user"),
+            order("john_smith", "VIP pub ~ 1", "VIP"),
+            order("maria_de_silva", "VIP pub ~ 1", "VIP exhausted"),
+            order("john_smith", "Nope", "no such coupon"),
+            order("maria_de_silva", null, "plain 2"),
+            order("maria_de_silva", null, "full"),
+            order("maria_de_silva", "-15%+Reopen pub ~ ~", "reopen"),
+            order("maria_de_silva", "-15%+Reopen pub ~ ~", "reopen 2"),
+            order("maria_de_silva", "-15%+Reopen pub ~ ~", "reopen 3"),
+        ],)
+        results = response.json()["results"]
+        self.assertEqual([result.get("message") for result in results], [
+            None,
+            "No such user_name",
+            None,
+            "Sorry, the framework for this coupon has been exhausted by customers",
+            "No such coupon_name",
+            None,
+            "Sorry, the waiting room is full. Please try again later",
+            None,
+            None,
+            "You cannot use this coupon more",
+        ])
+        self.assertEqual(response.json()["queue_len"], 5)
+        self.assertEqual([result["final_price"] for result in results if "id" in result],
+                         [20000, 20000, 20000, 17000, 17000])
+        self.assertEqual([result["queue_position"] for result in results if "id" in result], [1, 0, 2, 3, 4])
+        for result in results:
+            if "id" in result:
+                response = client.get(f"/queue/{result['id']}/position")
+                self.assertEqual(response.json()["queue_position"], result["queue_position"])
+        response = client.post("/queue", json=order("maria_de_silva", "VIP pub ~ 1", "VIP exhausted"),)
+        self.assertEqual(response.json(), {
+            "message": "Sorry, the framework for this coupon has been exhausted by customers"
+        })
+
+    def test_consume(self):
+        """Test consuming from the queue marks items completed, in queue order"""
+        client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "VIP pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        for coupon_name, order_id in [(null, "1st non-VIP"), (null, "2nd non-VIP"), ("VIP pub ~ ~", "1st VIP")]:
+            client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": coupon_name,
+                "list_price": 20000,
+                "order_id": order_id
+            },)
+        response = client.post("/queue/consume/2").json()
+        self.assertEqual([q["order_id"] for q in response["queue_items"]], ["1st VIP", "1st non-VIP"])
+        self.assertTrue(all(q["completed_at"] for q in response["queue_items"]))
+        self.assertEqual(response["queue_len"], 1)
+        self.assertEqual([q["order_id"] for q in client.get("/queue").json()["queue_items"]], ["2nd non-VIP"])
+        self.assertEqual(client.put("/queue/shift/5").json(), {"shifted": 1, "queue_len": 0})
+        self.assertEqual(client.post("/queue/consume/0").status_code, 422)
+        self.assertEqual(client.put("/queue/shift/-1").status_code, 422)
+
+    def test_queue_write_lock(self):
+        """Test concurrent claims on SQLite don't get the same item: the lock is taken before the select"""
+        if db.engine.dialect.name != "sqlite":
+            self.skipTest("SQLite's write lock")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = db.create_engine(f"sqlite:///{tmp_dir}/lock.db", connect_args={"check_same_thread": False})
+            db.SQLModel.metadata.create_all(engine)
+            with db.Session(engine) as session:
+                session.execute(db.text("INSERT INTO user (user_name) VALUES ('john_smith')"))
+                session.add(db.Qitem(user_name="john_smith", order_id="L1", final_price=1))
+                session.commit()
+            claimed = {}
+
+            def claim(worker, session):
+                claimed[worker] = queue_item._update_head(session, 1, claimed_by=worker)  # pylint: disable=protected-access
+                session.commit()
+
+            with db.Session(engine) as session, db.Session(engine) as other:
+                queue_item._update_head(session, 1, claimed_by="w1")  # pylint: disable=protected-access
+                thread = threading.Thread(target=claim, args=("w2", other))
+                thread.start()
+                time.sleep(0.2)  # w2 waits for the lock
+                session.commit()
+                thread.join()
+            engine.dispose()
+        self.assertEqual(claimed["w2"], [])
+
+    def test_batch_uses_write_lock(self):
+        """Test a redemption concurrent with a batch on SQLite waits for it: counters are read after the lock"""
+        if db.engine.dialect.name != "sqlite":
+            self.skipTest("SQLite's write lock")
+        coupon_dict = {"coupon_name": "Two", "max_use_count_per_user": None, "max_use_count_global": 2}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = db.create_engine(f"sqlite:///{tmp_dir}/lock.db", connect_args={"check_same_thread": False})
+            db.SQLModel.metadata.create_all(engine)
+            with db.Session(engine) as session:
+                session.add(db.Coupon(coupon_name="Two", max_use_count_global=2))
+                session.add(db.CouponUse(coupon_name="Two", use_count=1))
+                session.commit()
+            redeemed = []
+
+            def redeem(session):
+                try:
+                    coupon._count_use(session, db.CouponUse, 2, "limit", coupon_name="Two")  # pylint: disable=protected-access
+                    session.commit()
+                    redeemed.append(True)
+                except exception.CouponUserError:
+                    redeemed.append(False)
+
+            with db.Session(engine) as session, db.Session(engine) as other:
+                uses = coupon.BatchUses(session, [(coupon_dict, "john_smith")])
+                counters = uses.check(coupon_dict, "john_smith")
+                thread = threading.Thread(target=redeem, args=(other,))
+                thread.start()
+                time.sleep(0.2)  # the redemption waits for the lock
+                uses.use(counters)
+                session.commit()
+                thread.join()
+            with db.Session(engine) as session:
+                self.assertEqual(session.get(db.CouponUse, "Two").use_count, 2)
+            engine.dispose()
+        self.assertEqual(redeemed, [False])
+
+    def test_claim(self):
+        """Test workers claiming, extending and completing queue items"""
+        ids = []
+        for _ in range(4):
+            response = client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": null,
+                "list_price": 20000,
+                "order_id": "RDR42/" + str(_)
+            },)
+            ids.append(response.json()["id"])
+
+        response = client.post("/queue/claim", json={"worker": "w1", "count": 2})
+        self.assertEqual([q["id"] for q in response.json()["queue_items"]], ids[:2])
+        response = client.post("/queue/claim", json={"worker": "w2"})
+        self.assertEqual([q["id"] for q in response.json()["queue_items"]], ids[2:3])
+        self.assertEqual([q["id"] for q in client.post("/queue/consume/5").json()["queue_items"]], ids[3:])
+
+        response = client.post(f"/queue/{ids[0]}/complete", json={"worker": "w2"})
+        self.assertEqual(response.status_code, 404)
+        response = client.put(f"/queue/{ids[0]}/lease", json={"worker": "w1"})
+        self.assertEqual(response.status_code, 200)
+        response = client.post(f"/queue/{ids[0]}/complete", json={"worker": "w1"})
+        self.assertEqual(response.status_code, 200)
+        response = client.post(f"/queue/{ids[0]}/complete", json={"worker": "w1"})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(client.get("/queue/len").json(), 2)
+
+        # w2 let its lease expire, so w3 gets the item
+        self.addCleanup(setattr, settings, "lease_secs", settings.lease_secs)
+        settings.lease_secs = -1
+        client.put(f"/queue/{ids[2]}/lease", json={"worker": "w2"})
+        response = client.post("/queue/claim", json={"worker": "w3", "count": 3})
+        self.assertEqual([q["id"] for q in response.json()["queue_items"]], ids[2:3])
+        response = client.post(f"/queue/{ids[2]}/complete", json={"worker": "w2"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_pricing_frequenter_percent(self):
+        """Test discount by percentage for frequent buyers, counted when orders are completed"""
+        self.addCleanup(setattr, settings, "min_frequenter_orders", settings.min_frequenter_orders)
+        settings.min_frequenter_orders = 2
+        client.post("/coupon", json={
+            "params": {"pricing": {"frequenter_percent": -10}},
+            "coupon_name": "-10% frequenter pub ~ ~",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+
+        def order(order_id):
+            return client.post("/queue", json={
+                "user_name": "john_smith",
+                "coupon_name": "-10% frequenter pub ~ ~",
+                "list_price": 20000,
+                "order_id": order_id
+            },).json()
+
+        self.assertEqual(order("RDR1")["final_price"], 20000)
+        self.assertEqual(order("RDR2")["final_price"], 20000)
+        client.post("/queue/consume/1")
+        self.assertEqual(order("RDR3")["final_price"], 20000)  # 1 completed only
+        client.post("/queue/claim", json={"worker": "w1"})
+        response = client.post("/queue/claim", json={"worker": "w1"})
+        client.post(f"/queue/{response.json()['queue_items'][0]['id']}/complete", json={"worker": "w1"})
+        self.assertEqual(order("RDR4")["final_price"], 18000)
+
+    def test_coupon_param_query(self):
+        """Test listing coupons having a param (with value)"""
+        for coupon_name, params in [("VIP", {"queuing": {"vip": 1}}),
+                                    ("VIP+Reopen", {"queuing": {"vip": 1, "reopen": True}}),
+                                    ("-15%", {"pricing": {"percent": -15}}),
+                                    ("-5%", {"pricing": {"percent": -5}})]:
+            client.post("/coupon", json={
+                "params": params,
+                "coupon_name": coupon_name,
+                "user_name": null,
+                "max_use_count_per_user": null,
+                "max_use_count_global": null
+            },)
+        for query, coupon_names in [
+            ({"param": "queuing.vip"}, ["VIP", "VIP+Reopen"]),
+            ({"param": "queuing.reopen", "value": "true"}, ["VIP+Reopen"]),
+            ({"param": "pricing.percent", "value": "-15"}, ["-15%"]),
+            ({"param": "pricing.amount"}, []),
+        ]:
+            response = client.get("/coupon", params=query)
+            self.assertEqual([c["coupon_name"] for c in response.json()["coupons"]], coupon_names, query)
+        self.assertEqual(client.get("/coupon", params={"param": "nope.vip"}).status_code, 400)
+        self.assertEqual(client.get("/coupon", params={"param": "queuing.vip", "value": "{"}).status_code, 400)
+        self.assertEqual(client.get("/coupon", params={"param": "queuing.vip", "value": '{"a":1}'}).status_code, 400)
+        self.assertEqual(client.get("/coupon", params={"param": "queuing.vip", "value": "[1]"}).status_code, 400)
+
+    def test_metrics(self):
+        """Test metrics in Prometheus text format"""
+        def sample(text, name):
+            return float(dict(line.rsplit(" ", 1) for line in text.splitlines()
+                              if not line.startswith("#")).get(name, 0))
+        before = client.get("/metrics").text
+        client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "Once",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": 1
+        },)
+        order = {"user_name": "john_smith", "coupon_name": "Once", "list_price": 20000, "order_id": "M1"}
+        self.assertEqual(client.post("/queue", json=order).status_code, 200)
+        self.assertEqual(client.post("/queue", json=order).status_code, 400)
+        self.assertEqual(client.get("/coupon/Nope").status_code, 404)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        for name, delta in [
+            ('coupon_redemptions_total{coupon_name="Once"}', 1),
+            ('coupon_rejections_total{reason="exhausted"}', 1),
+            ('coupon_http_request_duration_seconds_count{method="POST",route="/queue",status="400"}', 1),
+            ('coupon_http_request_duration_seconds_count{method="GET",route="/coupon/{coupon_name}",status="404"}',
+             1),
+            ('coupon_http_request_db_seconds_count{method="POST",route="/queue",status="200"}', 1),
+        ]:
+            self.assertEqual(sample(response.text, name) - sample(before, name), delta, name)
+        self.assertEqual(sample(response.text, 'coupon_queue_length{vip="1"}'), 1)
+        self.assertGreater(
+            sample(response.text, 'coupon_http_request_db_seconds_sum{method="POST",route="/queue",status="200"}'), 0)
+
+    def test_query_budget(self):
+        """Test the number of SQL statements of hot endpoints, to catch N+1 queries"""
+        client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}, "pricing": {"percent": -10}},
+            "coupon_name": "Budget",
+            "user_name": null,
+            "max_use_count_per_user": 10,
+            "max_use_count_global": 100
+        },)
+        order = {"user_name": "john_smith", "coupon_name": "Budget", "list_price": 20000, "order_id": "B1"}
+        client.post("/queue", json=order)  # creates redemption counters
+        # 2 counter UPDATEs, queue lock, queue len, INSERT, position
+        qitem_id = self.assert_query_budget(6, "POST", "/queue", json=order).json()["id"]
+        self.assert_query_budget(4, "POST", "/queue", json={**order, "coupon_name": null})
+        self.assert_query_budget(1, "GET", "/coupon/Budget")
+        self.assert_query_budget(2, "GET", f"/queue/{qitem_id}/position")
+        self.assert_query_budget(1, "GET", "/queue", params={"limit": 10})
+        self.assert_query_budget(1, "GET", "/queue/len")
+
+    def test_archive(self):
+        """Test moving completed queue items to the archive, history counted from there"""
+        client.post("/coupon", json={
+            "params": {"pricing": {"frequenter_percent": -10}},
+            "coupon_name": "Twice",
+            "user_name": null,
+            "max_use_count_per_user": 2,
+            "max_use_count_global": null
+        },)
+        order = {"user_name": "john_smith", "coupon_name": "Twice", "list_price": 20000, "order_id": "A1"}
+        for _ in range(2):
+            client.post("/queue", json=order)
+        client.post("/queue", json={**order, "coupon_name": null})
+        client.post("/queue/consume/2")
+        response = client.post("/queue/archive", params={"batch_size": 1})
+        self.assertEqual(response.json(), {"archived": 2})
+        self.assertEqual(client.post("/queue/archive").json(), {"archived": 0})
+        self.assertEqual([item["coupon_name"] for item in client.get("/queue").json()["queue_items"]], [null])
+
+        with db.Session(db.engine) as session:  # counters lost, to be backfilled from the archive
+            for cls in [db.CouponUserUse, db.UserStat]:
+                for record in session.exec(db.select(cls)):
+                    session.delete(record)
+            session.commit()
+        self.addCleanup(setattr, settings, "min_frequenter_orders", settings.min_frequenter_orders)
+        settings.min_frequenter_orders = 2
+        response = client.post("/queue", json=order)
+        self.assertEqual(response.json()["message"], "You cannot use this coupon more")
+        client.post("/coupon", json={
+            "params": {"pricing": {"frequenter_percent": -10}},
+            "coupon_name": "Frequenter",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        client.post("/queue/consume/1")  # stats backfilled: 2 archived + 1 just completed
+        with db.Session(db.engine) as session:
+            self.assertEqual(session.get(db.UserStat, "john_smith").completed_orders, 3)
+        response = client.post("/queue", json={**order, "coupon_name": "Frequenter"})
+        self.assertEqual(response.json()["final_price"], 18000)
+
+    def test_archive_all_again(self):
+        """Test archiving the whole queue, then new orders: their ids are new, not the archived ones"""
+        order = {"user_name": "john_smith", "coupon_name": null, "list_price": 20000, "order_id": "A2"}
+        archived_ids = [client.post("/queue", json=order).json()["id"] for _ in range(3)]
+        client.post("/queue/consume/3")
+        self.assertEqual(client.post("/queue/archive").json(), {"archived": 3})
+        new_ids = [client.post("/queue", json=order).json()["id"] for _ in range(2)]
+        self.assertGreater(min(new_ids), max(archived_ids))
+        client.post("/queue/consume/2")
+        self.assertEqual(client.post("/queue/archive").json(), {"archived": 2})
+        with db.Session(db.engine) as session:
+            self.assertEqual(session.get(db.UserStat, "john_smith").completed_orders, 5)
+
+    def test_read_replica(self):
+        """Test routing reads to a replica, another local database here that is never in sync"""
+        self.addCleanup(setattr, settings, "db_replica_urls", settings.db_replica_urls)
+        settings.db_replica_urls = ["sqlite://"]  # in-memory
+        db.SQLModel.metadata.create_all(db.get_replicas()[0].engine)
+        client.post("/coupon", json={
+            "params": {},
+            "coupon_name": "Primary",
+            "user_name": null,
+            "max_use_count_per_user": 1,
+            "max_use_count_global": null
+        },)
+        order = {"user_name": "john_smith", "coupon_name": "Primary", "list_price": 20000, "order_id": "R1"}
+        self.assertEqual(client.post("/queue", json=order).status_code, 200)
+        # limit checks are on the primary
+        self.assertEqual(client.post("/queue", json=order).status_code, 400)
+
+        self.assertEqual(client.get("/coupon").json(), {"coupons": []})
+        self.assertEqual([c["coupon_name"] for c in client.get("/coupon?fresh=true").json()["coupons"]],
+                         ["Primary"])
+        self.assertEqual(client.get("/coupon/Primary").status_code, 200)  # confirmed on the primary
+        self.assertEqual(client.get("/queue").json(), {"queue_items": []})
+        self.assertEqual(len(client.get("/queue?fresh=true").json()["queue_items"]), 1)
+        self.assertEqual(client.get("/queue/len").json(), 0)
+        self.assertEqual(client.get("/queue/len?fresh=true").json(), 1)
+
+        self.addCleanup(setattr, settings, "db_replica_max_lag", settings.db_replica_max_lag)
+        settings.db_replica_max_lag = -1  # replica too far behind
+        self.assertEqual(client.get("/queue/len").json(), 1)
+
+    def test_position_events(self):
+        """Test position updates pushed by the change feed"""
+        client.post("/coupon", json={
+            "params": {"queuing": {"vip": 1}},
+            "coupon_name": "VIP",
+            "user_name": null,
+            "max_use_count_per_user": null,
+            "max_use_count_global": null
+        },)
+        order = {"user_name": "john_smith", "coupon_name": null, "list_price": 20000, "order_id": "E1"}
+        ids = [client.post("/queue", json=order).json()["id"] for _ in range(2)]
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscription = queue_item.subscribe(ids[1], loop, with_len=True)
+
+        client.post("/queue", json={**order, "coupon_name": "VIP"})  # ahead
+        client.post("/queue", json=order)  # behind
+        client.post("/queue/consume/2")  # VIP and ids[0]
+        client.post("/queue/consume/1")  # itself
+        loop.run_until_complete(asyncio.sleep(0))  # run callbacks scheduled by publishing threads
+        events = [subscription.events.get_nowait() for _ in range(subscription.events.qsize())]
+        self.assertEqual(events, [
+            {"id": ids[1], "queue_position": 1, "queue_len": 2},
+            {"id": ids[1], "queue_position": 2, "queue_len": 3},
+            {"id": ids[1], "queue_position": 2, "queue_len": 4},
+            {"id": ids[1], "queue_position": 0, "queue_len": 2},
+            {"id": ids[1], "queue_position": null, "queue_len": 1},
+        ])
+        self.assertEqual(client.get("/queue/0/events").status_code, 404)
+
+    def test_position_events_sync(self):
+        """Test subscribing while a write is published, and resyncing from DB"""
+        order = {"user_name": "john_smith", "coupon_name": null, "list_price": 20000, "order_id": "E1"}
+        qitem_id = client.post("/queue", json=order).json()["id"]
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscriptions = []
+
+        class Racing:  # pylint: disable=too-few-public-methods
+            """Session whose commit is followed by a subscription before the write is published"""
+
+            def __init__(self, session):
+                self.session = session
+
+            def commit(self):
+                """Commit, then subscribe"""
+                self.session.commit()
+                subscriptions.append(queue_item.subscribe(qitem_id, loop, with_len=True))
+
+        with db.Session(db.engine) as session:  # VIP, ahead, in the snapshot already
+            record = db.Qitem(user_name="john_smith", order_id="E2", final_price=1, vip=1)
+            session.add(record)
+            session.flush()
+            feed.commit(Racing(session), added=[{"id": record.id, "vip": 1}])
+        with db.Session(db.engine) as session:  # behind, by another worker process, not published
+            session.add(db.Qitem(user_name="john_smith", order_id="E3", final_price=1))
+            session.commit()
+        feed.sync(subscriptions[0])
+        loop.run_until_complete(asyncio.sleep(0))
+        events = [subscriptions[0].events.get_nowait() for _ in range(subscriptions[0].events.qsize())]
+        self.assertEqual(events, [
+            {"id": qitem_id, "queue_position": 1, "queue_len": 2},
+            {"id": qitem_id, "queue_position": 1, "queue_len": 3},
+        ])
+        feed.unsubscribe(subscriptions[0])
+
+    def test_etag(self):
+        """Test conditional GET of listings, served from cache until the table changes"""
+        order = {"user_name": "john_smith", "coupon_name": null, "list_price": 20000, "order_id": "T1"}
+        client.post("/queue", json=order)
+        for url, change in [
+            ("/queue?limit=10", lambda: client.post("/queue/consume/1")),
+            ("/coupon", lambda: client.post("/coupon", json={"params": {}, "coupon_name": "New"})),
+        ]:
+            response = client.get(url)
+            etag = response.headers["etag"]
+            settings.sql_profile = True
+            try:
+                response = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 304, url)
+                self.assertEqual(response.headers["x-sql-statements"], "0", url)
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                self.assertEqual(response.headers["x-sql-statements"], "0", url)
+            finally:
+                settings.sql_profile = False
+            change()
+            response = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200, url)
+            self.assertNotEqual(response.headers["etag"], etag, url)
+
+        # cached by the query params used, other ones don't add entries; big bodies are not cached
+        cached = client.get("/cache").json()["listings"]["size"]
+        for junk in range(3):
+            client.get("/queue", params={"limit": 5, "junk": junk})
+        self.assertEqual(client.get("/cache").json()["listings"]["size"], cached + 1)
+        self.addCleanup(setattr, settings, "listing_cache_max_body", settings.listing_cache_max_body)
+        settings.listing_cache_max_body = 10
+        self.assertEqual(client.get("/queue", params={"limit": 6}).status_code, 200)
+        self.assertEqual(client.get("/cache").json()["listings"]["size"], cached + 1)
+
+    def test_columnar(self):
+        """Test columnar format of listings"""
+        order = {"user_name": "john_smith", "coupon_name": null, "list_price": 20000, "order_id": "C1"}
+        for _ in range(3):
+            client.post("/queue", json=order)
+        client.post("/coupon", json={"params": {"queuing": {"vip": 1}}, "coupon_name": "Col"})
+        for url, key in [("/queue?limit=2", "queue_items"), ("/coupon", "coupons")]:
+            rows = client.get(url).json()
+            cols = client.get(url, params={"format": "columnar"}).json()
+            self.assertEqual(cols.get("next"), rows.get("next"), url)
+            self.assertEqual(
+                cols[key], {k: [row[k] for row in rows[key]] for k in rows[key][0]}, url)
+        self.assertEqual(client.get("/queue?after=0:1000000&format=columnar").json(),
+                         {"queue_items": {k: [] for k in queue_item.LISTING_KEYS}})
+
 
 if __name__ == "__main__":
     unittest.main()